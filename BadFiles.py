@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# This module keeps the lists of bad videos and bad sizes for MergeTeslaCam
+# in memory. New entries are appended to a journal in STATE_PATH, so a
+# lookup never touches the disk and an addition costs one short write. The
+# journal is compacted into the sorted, human-readable BAD_VIDEOS_FILENAME
+# and BAD_SIZES_FILENAME files in each Raw folder once it holds
+# BAD_FILES_COMPACT_ENTRIES entries or its oldest entry is
+# BAD_FILES_COMPACT_AGE seconds old, and when the service stops. Compaction
+# merges the journal into the list as it is on disk, so lines edited or
+# removed by hand are kept that way.
+
+import os
+import time
+import threading
+import logging
+import TCMConstants
+
+lock = threading.RLock()
+registries = {}	# (folder, filename) -> {key: line}
+journals = {}	# (folder, filename) -> [entries in the journal, time of the oldest one]
+
+def get_list_path(folder, filename):
+	return f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{filename}"
+
+def get_journal_path(folder, filename):
+	return f"{TCMConstants.STATE_PATH}{folder.replace('/', '-')}-{filename}.journal"
+
+def get_key(line):
+	return line.rstrip("\n").split(":", 1)[0]
+
+def read_entries(path, entries):
+	if os.path.isfile(path):
+		with open(path, "r") as file:
+			for line in file:
+				if line.strip():
+					entries[get_key(line)] = line if line.endswith("\n") else f"{line}\n"
+	return entries
+
+def get_registry(folder, filename):
+	with lock:
+		if (folder, filename) not in registries:
+			entries = read_entries(get_list_path(folder, filename), {})
+			journal = read_entries(get_journal_path(folder, filename), {})
+			entries.update(journal)
+			registries[(folder, filename)] = entries
+			if journal:
+				journals[(folder, filename)] = [len(journal), os.path.getmtime(get_journal_path(folder, filename))]
+		return registries[(folder, filename)]
+
+def contains(folder, filename, key):
+	return key in get_registry(folder, filename)
+
+def add(folder, filename, key, line):
+	# Returns True if the entry is new
+	with lock:
+		entries = get_registry(folder, filename)
+		if key in entries:
+			return False
+		entries[key] = line
+		try:
+			os.makedirs(TCMConstants.STATE_PATH, exist_ok=True)
+			with open(get_journal_path(folder, filename), "a") as journal:
+				journal.write(line)
+		except OSError as error:
+			logging.getLogger(TCMConstants.get_basename()).error(
+				f"Failed to add to journal {get_journal_path(folder, filename)}: {error}")
+		journals.setdefault((folder, filename), [0, time.time()])[0] += 1
+		return True
+
+def export(force=False):
+	# Compacts the journals that are big or old enough, or all of them if force
+	logger = logging.getLogger(TCMConstants.get_basename())
+	with lock:
+		for (folder, filename), (count, oldest) in sorted(journals.items()):
+			if not force and count < TCMConstants.BAD_FILES_COMPACT_ENTRIES and time.time() - oldest < TCMConstants.BAD_FILES_COMPACT_AGE:
+				continue
+			name = get_list_path(folder, filename)
+			try:
+				entries = read_entries(name, {})
+				entries.update(read_entries(get_journal_path(folder, filename), {}))
+				with open(f"{name}.tmp", "w") as writer:
+					for line in sorted(entries.values()):
+						writer.write(line)
+				os.replace(f"{name}.tmp", name)
+				if os.path.isfile(get_journal_path(folder, filename)):
+					os.remove(get_journal_path(folder, filename))
+				logger.debug(f"Compacted {count} journal entries into {name}")
+			except OSError as error:
+				logger.error(f"Failed to export {name}: {error}")
+				continue
+			registries[(folder, filename)] = entries
+			del journals[(folder, filename)]
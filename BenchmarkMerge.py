@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# This script measures how fast this computer runs the ffmpeg commands that
+# MergeTeslaCam uses, so the encoder settings in TCMConstants.py can be
+# tuned with data. It generates synthetic clips for the four cameras with
+# ffmpeg's testsrc in a temporary folder, then runs the real merge commands
+# for every combination of the settings given on the command line. For each
+# run it reports frames per second, wall and CPU time, peak memory and
+# output size as JSON or CSV. Example:
+#
+#	./BenchmarkMerge.py --widths 960,1200 --presets medium,veryfast --threads 0,2 --format csv
+#	./BenchmarkMerge.py --types 1 --fast-modes retime,keyframe,stride --fast-widths 0,640
+
+import os
+import sys
+import argparse
+import itertools
+import tempfile
+import shutil
+import json
+import csv
+import TCMConstants
+import MergeTeslaCam
+
+BENCHMARK_FOLDER = 'Benchmark'
+BENCHMARK_STAMP = '2020-01-01_12-00-00'
+CAMERA_SIZE = '1280x960'
+CAMERA_RATE = 36
+VIDEO_TYPES = {0 : 'Merge', 1 : 'Fast preview', 2 : 'Merge and fast preview'}
+
+full_file_settings = None	# settings the full video in the work folder was made with
+
+logger = TCMConstants.get_logger()
+
+def main():
+	args = parse_arguments()
+	work_path = tempfile.mkdtemp(prefix="tcm-benchmark-")
+	try:
+		TCMConstants.FOOTAGE_PATH = f"{work_path}/"
+		for folder in [TCMConstants.RAW_FOLDER, TCMConstants.FULL_FOLDER, TCMConstants.FAST_FOLDER]:
+			os.makedirs(f"{work_path}/{BENCHMARK_FOLDER}/{folder}")
+		if not generate_inputs(work_path, args.duration):
+			sys.exit(TCMConstants.SPECIAL_EXIT_CODE)
+		results = []
+		for width, scaler, preset, crf, threads, fast_mode, fast_width in itertools.product(
+				args.widths, args.scalers, args.presets, args.crfs, args.threads, args.fast_modes, args.fast_widths):
+			overrides = {
+				"front_width" : width,
+				"scaler" : scaler,
+				"full_encoder" : f"{TCMConstants.FFMPEG_FULL_ENCODER} -preset {preset} -crf {crf}",
+				"fast_encoder" : f"{TCMConstants.FFMPEG_FAST_ENCODER} -preset {preset}",
+				"threads" : threads,
+				"fast_mode" : fast_mode,
+				"fast_width" : fast_width
+			}
+			for video_type in args.types:
+				result = run_benchmark(video_type, overrides, args.duration)
+				result.update({"front_width" : width, "scaler" : scaler or "default",
+					"preset" : preset, "crf" : crf, "threads" : threads, "fast_mode" : fast_mode, "fast_width" : fast_width})
+				results.append(result)
+				print(f"{result['video_type']}, width {width}, scaler {result['scaler']}, preset {preset}, crf {crf}, threads {threads}, fast {fast_mode} {fast_width}: {result['fps']} fps", file=sys.stderr)
+		write_results(results, args.format, args.output)
+	finally:
+		if args.keep:
+			print(f"Kept benchmark files in {work_path}", file=sys.stderr)
+		else:
+			shutil.rmtree(work_path, ignore_errors=True)
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(description="Benchmark the TeslaCamMerge ffmpeg commands")
+	parser.add_argument("--duration", type=int, default=60, help="length of the synthetic clips in seconds")
+	parser.add_argument("--widths", default=str(TCMConstants.FRONT_WIDTH), help="comma-separated FRONT_WIDTH values, multiples of 12")
+	parser.add_argument("--scalers", default=TCMConstants.FFMPEG_SCALER_FLAGS, help="comma-separated scaler flags, empty for ffmpeg's default")
+	parser.add_argument("--presets", default="medium", help="comma-separated x264 presets")
+	parser.add_argument("--crfs", default="23", help="comma-separated x264 CRF values for full videos")
+	parser.add_argument("--threads", default=str(TCMConstants.FFMPEG_THREADS), help="comma-separated ffmpeg thread counts")
+	parser.add_argument("--fast-modes", default=TCMConstants.FAST_PREVIEW_MODE, help="comma-separated fast preview modes: retime, keyframe, stride")
+	parser.add_argument("--fast-widths", default=str(TCMConstants.FAST_PREVIEW_WIDTH), help="comma-separated fast preview widths, 0 for full size")
+	parser.add_argument("--types", default="0,1,2", help="comma-separated video types: 0 merge, 1 fast preview, 2 both in one pass")
+	parser.add_argument("--format", choices=["json", "csv"], default="json")
+	parser.add_argument("--output", help="file to write the results to, standard output if not given")
+	parser.add_argument("--keep", action="store_true", help="keep the synthetic clips and outputs")
+	args = parser.parse_args()
+	args.widths = [int(item) for item in args.widths.split(",")]
+	args.scalers = args.scalers.split(",")
+	args.presets = args.presets.split(",")
+	args.crfs = [int(item) for item in args.crfs.split(",")]
+	args.threads = [int(item) for item in args.threads.split(",")]
+	args.fast_modes = args.fast_modes.split(",")
+	args.fast_widths = [int(item) for item in args.fast_widths.split(",")]
+	args.types = sorted(int(item) for item in args.types.split(","))
+	return args
+
+def generate_inputs(work_path, duration):
+	for camera in [TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.RIGHT_TEXT, TCMConstants.BACK_TEXT]:
+		command = f"{MergeTeslaCam.ffmpeg_base} -f lavfi -i testsrc=size={CAMERA_SIZE}:rate={CAMERA_RATE}:duration={duration} -c:v libx264 -preset ultrafast {work_path}/{BENCHMARK_FOLDER}/{TCMConstants.RAW_FOLDER}/{BENCHMARK_STAMP}-{camera}"
+		completed = TCMConstants.run_timed(command)
+		if completed.returncode != 0:
+			logger.error(f"Error generating input with: {command}, stderr: {completed.stderr}")
+			print(f"Could not generate synthetic clips: {completed.stderr.decode('UTF-8')}", file=sys.stderr)
+			return False
+	return True
+
+def get_full_settings(overrides):
+	return tuple(overrides[name] for name in ["front_width", "scaler", "full_encoder", "threads"])
+
+def run_benchmark(video_type, overrides, duration):
+	global full_file_settings
+	full_file = f"{TCMConstants.FOOTAGE_PATH}{BENCHMARK_FOLDER}/{TCMConstants.FULL_FOLDER}/{BENCHMARK_STAMP}-{TCMConstants.FULL_TEXT}"
+	fast_file = f"{TCMConstants.FOOTAGE_PATH}{BENCHMARK_FOLDER}/{TCMConstants.FAST_FOLDER}/{BENCHMARK_STAMP}-{TCMConstants.FAST_TEXT}"
+	outputs = {0 : [full_file], 1 : [fast_file], 2 : [full_file, fast_file]}[video_type]
+	for output in outputs:
+		if os.path.isfile(output):
+			os.remove(output)
+	if video_type == 1 and (full_file_settings != get_full_settings(overrides) or not os.path.isfile(full_file)):
+		# The fast preview is made from a full video with the same settings
+		if os.path.isfile(full_file):
+			os.remove(full_file)
+		TCMConstants.run_timed(MergeTeslaCam.get_ffmpeg_command(BENCHMARK_FOLDER, BENCHMARK_STAMP, 0, overrides))
+		full_file_settings = get_full_settings(overrides)
+	command = MergeTeslaCam.get_ffmpeg_command(BENCHMARK_FOLDER, BENCHMARK_STAMP, video_type, overrides)
+	completed = TCMConstants.run_timed(command)
+	if video_type != 1:
+		full_file_settings = get_full_settings(overrides)
+	if completed.returncode != 0:
+		logger.error(f"Benchmark command failed: {command}, stderr: {completed.stderr}")
+	return {
+		"video_type" : VIDEO_TYPES[video_type],
+		"returncode" : completed.returncode,
+		"fps" : round(duration * CAMERA_RATE / completed.wall_time, 2),
+		"wall_time" : round(completed.wall_time, 2),
+		"cpu_time" : round(completed.cpu_time, 2),
+		"max_rss_kb" : completed.max_rss,
+		"output_size" : sum(os.path.getsize(output) for output in outputs if os.path.isfile(output))
+	}
+
+def write_results(results, output_format, output_name):
+	output = open(output_name, "w", newline="") if output_name else sys.stdout
+	try:
+		if output_format == "json":
+			json.dump(results, output, indent=2)
+			output.write("\n")
+		else:
+			writer = csv.DictWriter(output, fieldnames=list(results[0].keys()) if results else [])
+			writer.writeheader()
+			writer.writerows(results)
+	finally:
+		if output_name:
+			output.close()
+
+if __name__ == '__main__':
+	main()
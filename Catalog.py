@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# This module keeps a SQLite catalog of the footage handled by the services,
+# if CATALOG_FILENAME is set. LoadSSD records clips and events as they
+# arrive, MergeTeslaCam records merged outputs and bad files, RemoveOld
+# records deletions and Stats reports from it. The database is in WAL mode
+# so the services can use it at the same time. Errors are logged and
+# otherwise ignored: the catalog is a shortcut, the files on disk remain
+# the source of truth.
+
+import os
+import sqlite3
+import threading
+import time
+import logging
+import TCMConstants
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+	car TEXT NOT NULL,
+	folder TEXT NOT NULL,
+	stamp TEXT NOT NULL,
+	camera TEXT NOT NULL,
+	size INTEGER,
+	arrived REAL,
+	bad INTEGER NOT NULL DEFAULT 0,
+	deleted REAL,
+	PRIMARY KEY (car, folder, stamp, camera));
+CREATE TABLE IF NOT EXISTS stamps (
+	car TEXT NOT NULL,
+	folder TEXT NOT NULL,
+	stamp TEXT NOT NULL,
+	full_done REAL,
+	fast_done REAL,
+	full_profile TEXT,
+	fast_profile TEXT,
+	bad_size INTEGER NOT NULL DEFAULT 0,
+	deleted REAL,
+	PRIMARY KEY (car, folder, stamp));
+CREATE TABLE IF NOT EXISTS events (
+	car TEXT NOT NULL,
+	folder TEXT NOT NULL,
+	stamp TEXT NOT NULL,
+	reason TEXT,
+	city TEXT,
+	camera TEXT,
+	PRIMARY KEY (car, folder, stamp));
+CREATE INDEX IF NOT EXISTS stamps_by_status ON stamps (car, folder, full_done, fast_done);
+"""
+# Columns added after the first release: table -> [(column, type)]
+ADDED_COLUMNS = {'stamps' : [('full_profile', 'TEXT'), ('fast_profile', 'TEXT')]}
+
+connections = threading.local()
+
+def get_connection():
+	connection = getattr(connections, "connection", None)
+	if connection is None:
+		os.makedirs(TCMConstants.STATE_PATH, exist_ok=True)
+		connection = sqlite3.connect(f"{TCMConstants.STATE_PATH}{TCMConstants.CATALOG_FILENAME}",
+			timeout=30, isolation_level=None)
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		connection.executescript(SCHEMA)
+		for table, columns in ADDED_COLUMNS.items():
+			existing = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+			for column, column_type in columns:
+				if column not in existing:
+					connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+		connections.connection = connection
+	return connection
+
+def execute(sql, parameters=()):
+	if not TCMConstants.CATALOG_FILENAME:
+		return []
+	try:
+		return get_connection().execute(sql, parameters).fetchall()
+	except (sqlite3.Error, OSError) as error:
+		logging.getLogger(TCMConstants.get_basename()).error(f"Catalog error: {error}, running: {sql}")
+		return []
+
+def split_folder(sub_path):
+	# "Car1/SavedClips" -> ("Car1", "SavedClips"), "SavedClips" -> ("", "SavedClips")
+	car, _, folder = sub_path.rpartition("/")
+	return car, folder
+
+### Updates ###
+
+def record_arrival(sub_path, name, size):
+	try:
+		stamp, camera = name.rsplit("-", 1)
+	except ValueError:
+		return
+	car, folder = split_folder(sub_path)
+	execute("INSERT OR IGNORE INTO clips (car, folder, stamp, camera) VALUES (?, ?, ?, ?)",
+		(car, folder, stamp, camera))
+	execute("UPDATE clips SET size = ?, arrived = ?, deleted = NULL WHERE car = ? AND folder = ? AND stamp = ? AND camera = ?",
+		(size, time.time(), car, folder, stamp, camera))
+
+def record_event(sub_path, stamp, event):
+	car, folder = split_folder(sub_path)
+	execute("INSERT OR REPLACE INTO events (car, folder, stamp, reason, city, camera) VALUES (?, ?, ?, ?, ?, ?)",
+		(car, folder, stamp, event.get("reason"), event.get("city"), event.get("camera")))
+
+def record_output(sub_path, stamp, full=False, fast=False, profile=None):
+	car, folder = split_folder(sub_path)
+	now = time.time()
+	execute("INSERT OR IGNORE INTO stamps (car, folder, stamp) VALUES (?, ?, ?)",
+		(car, folder, stamp))
+	execute("UPDATE stamps SET full_done = coalesce(?, full_done), fast_done = coalesce(?, fast_done), "
+		"full_profile = coalesce(?, full_profile), fast_profile = coalesce(?, fast_profile), "
+		"deleted = NULL WHERE car = ? AND folder = ? AND stamp = ?",
+		(now if full else None, now if fast else None, profile if full else None, profile if fast else None,
+		car, folder, stamp))
+
+def record_bad_clip(sub_path, name):
+	try:
+		stamp, camera = name.rsplit("-", 1)
+	except ValueError:
+		return
+	car, folder = split_folder(sub_path)
+	execute("INSERT OR IGNORE INTO clips (car, folder, stamp, camera) VALUES (?, ?, ?, ?)",
+		(car, folder, stamp, camera))
+	execute("UPDATE clips SET bad = 1 WHERE car = ? AND folder = ? AND stamp = ? AND camera = ?",
+		(car, folder, stamp, camera))
+
+def record_bad_size(sub_path, stamp):
+	car, folder = split_folder(sub_path)
+	execute("INSERT OR IGNORE INTO stamps (car, folder, stamp) VALUES (?, ?, ?)",
+		(car, folder, stamp))
+	execute("UPDATE stamps SET bad_size = 1 WHERE car = ? AND folder = ? AND stamp = ?",
+		(car, folder, stamp))
+
+def clear_settled(sub_path, stamp, full, fast):
+	# Forgets what the catalog has for a stamp whose files changed by hand:
+	# the outputs that are gone and the bad marks no longer in the lists
+	car, folder = split_folder(sub_path)
+	execute("UPDATE stamps SET full_done = CASE WHEN ? THEN full_done END, fast_done = CASE WHEN ? THEN fast_done END, "
+		"bad_size = 0 WHERE car = ? AND folder = ? AND stamp = ?", (full, fast, car, folder, stamp))
+	execute("UPDATE clips SET bad = 0 WHERE car = ? AND folder = ? AND stamp = ?", (car, folder, stamp))
+
+def record_deletion(sub_path, kind, stamp, camera=None):
+	car, folder = split_folder(sub_path)
+	now = time.time()
+	if kind == TCMConstants.RAW_FOLDER:
+		execute("UPDATE clips SET deleted = ? WHERE car = ? AND folder = ? AND stamp = ? AND camera = ?",
+			(now, car, folder, stamp, camera))
+	elif kind == TCMConstants.FULL_FOLDER:
+		execute("UPDATE stamps SET deleted = ?, full_done = NULL WHERE car = ? AND folder = ? AND stamp = ?",
+			(now, car, folder, stamp))
+	elif kind == TCMConstants.FAST_FOLDER:
+		execute("UPDATE stamps SET fast_done = NULL WHERE car = ? AND folder = ? AND stamp = ?",
+			(car, folder, stamp))
+
+def record_deletions(deletions):
+	# Records (sub_path, kind, stamp, camera) deletions in one transaction
+	if not deletions or not TCMConstants.CATALOG_FILENAME:
+		return
+	execute("BEGIN")
+	for sub_path, kind, stamp, camera in deletions:
+		record_deletion(sub_path, kind, stamp, camera)
+	execute("COMMIT")
+
+### Queries ###
+
+def get_output_profiles(sub_path, first, last):
+	# Returns {stamp: (full profile, fast profile)} for the stamps from first to last
+	car, folder = split_folder(sub_path)
+	rows = execute("SELECT stamp, full_profile, fast_profile FROM stamps WHERE car = ? AND folder = ? "
+		"AND stamp BETWEEN ? AND ? AND deleted IS NULL", (car, folder, first, last))
+	return {row[0]: (row[1], row[2]) for row in rows}
+
+def get_settled_stamps(sub_path):
+	# Stamps that need no more work: both outputs made, or bad input
+	car, folder = split_folder(sub_path)
+	rows = execute("SELECT stamp FROM stamps WHERE car = ? AND folder = ? AND deleted IS NULL "
+		"AND ((full_done IS NOT NULL AND fast_done IS NOT NULL) OR bad_size = 1) "
+		"UNION SELECT stamp FROM clips WHERE car = ? AND folder = ? AND bad = 1 AND deleted IS NULL",
+		(car, folder, car, folder))
+	return {row[0] for row in rows}
+
+def get_summary():
+	# Returns rows of (car, folder, merged stamps, stamps waiting to merge, bad clips)
+	merged = {(row[0], row[1]): row[2] for row in execute(
+		"SELECT car, folder, count(*) FROM stamps WHERE deleted IS NULL "
+		"AND full_done IS NOT NULL AND fast_done IS NOT NULL GROUP BY car, folder")}
+	waiting = {(row[0], row[1]): row[2] for row in execute(
+		"SELECT c.car, c.folder, count(DISTINCT c.stamp) FROM clips c LEFT JOIN stamps s USING (car, folder, stamp) "
+		"WHERE c.deleted IS NULL AND c.bad = 0 AND c.camera != ? AND (s.stamp IS NULL OR (s.deleted IS NULL "
+		"AND (s.full_done IS NULL OR s.fast_done IS NULL) AND s.bad_size = 0)) GROUP BY c.car, c.folder",
+		(TCMConstants.EVENT_JSON,))}
+	bad = {(row[0], row[1]): row[2] for row in execute(
+		"SELECT car, folder, count(*) FROM clips WHERE bad = 1 AND deleted IS NULL GROUP BY car, folder")}
+	keys = sorted(set(merged) | set(waiting) | set(bad))
+	return [(car, folder, merged.get((car, folder), 0), waiting.get((car, folder), 0), bad.get((car, folder), 0)) for car, folder in keys]
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# This module keeps the event.json files in each Raw folder sorted by their
+# timestamps, so that MergeTeslaCam can find the event for a stamp with a
+# binary search instead of listing and parsing the whole folder. LoadSSD
+# renames each event.json to "<timestamp>-event.json" when it moves it, and
+# MergeTeslaCam adds those files here as they show up in the Raw folders.
+# Descriptions are built from the JSON the first time they are needed and
+# then cached.
+
+import bisect
+import datetime
+import json
+import threading
+import logging
+import TCMConstants
+
+lock = threading.Lock()
+times = {}		# folder -> sorted list of event times
+stamps = {}		# folder -> event stamps, in the same order as times
+descriptions = {}	# (folder, event stamp) -> description
+
+def parse_stamp(stamp):
+	try:
+		return datetime.datetime.strptime(stamp, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
+	except ValueError:
+		return None
+
+def add(folder, stamp):
+	event_time = parse_stamp(stamp)
+	if event_time is None:
+		logging.getLogger(TCMConstants.get_basename()).debug(f"Ignoring event file with bad stamp: {stamp}")
+		return
+	with lock:
+		folder_times = times.setdefault(folder, [])
+		folder_stamps = stamps.setdefault(folder, [])
+		position = bisect.bisect_left(folder_times, event_time)
+		if position < len(folder_times) and folder_times[position] == event_time:
+			return
+		folder_times.insert(position, event_time)
+		folder_stamps.insert(position, stamp)
+
+def update(folder, event_stamps):
+	# Brings the index for a folder in line with the event files it contains
+	with lock:
+		gone = set(stamps.get(folder, [])) - set(event_stamps)
+		if gone:
+			kept = [(event_time, stamp) for event_time, stamp in zip(times[folder], stamps[folder]) if stamp not in gone]
+			times[folder] = [event_time for event_time, stamp in kept]
+			stamps[folder] = [stamp for event_time, stamp in kept]
+			for stamp in gone:
+				descriptions.pop((folder, stamp), None)
+	for stamp in event_stamps:
+		add(folder, stamp)
+
+def find(folder, stamp):
+	# Returns the stamp of the event closest to the given stamp within
+	# EVENT_DURATION seconds, or None
+	stamp_time = parse_stamp(stamp)
+	if stamp_time is None:
+		return None
+	max_delta = datetime.timedelta(seconds=TCMConstants.EVENT_DURATION)
+	with lock:
+		folder_times = times.get(folder, [])
+		low = bisect.bisect_left(folder_times, stamp_time - max_delta)
+		high = bisect.bisect_right(folder_times, stamp_time + max_delta)
+		if low == high:
+			return None
+		closest = min(range(low, high), key=lambda index: abs(folder_times[index] - stamp_time))
+		return stamps[folder][closest]
+
+def get_description(folder, stamp):
+	event_stamp = find(folder, stamp)
+	if event_stamp is None:
+		return None
+	with lock:
+		if (folder, event_stamp) in descriptions:
+			return descriptions[(folder, event_stamp)]
+	description = describe(folder, event_stamp)
+	if description is not None:
+		with lock:
+			descriptions[(folder, event_stamp)] = description
+	return description
+
+def describe(folder, event_stamp):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	try:
+		with open(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{event_stamp}-{TCMConstants.EVENT_JSON}", "r") as jsonfile:
+			event = json.load(jsonfile)
+	except (OSError, ValueError) as error:
+		logger.warning(f"Could not read event {event_stamp} in {folder}: {error}")
+		return None
+	jsonstamp = parse_stamp(event_stamp).strftime(TCMConstants.EVENT_TIMESTAMP_FORMAT)
+	try:
+		reason = TCMConstants.EVENT_REASON[event['reason']]
+	except:
+		reason = event.get('reason')
+	try:
+		camera = TCMConstants.EVENT_CAMERA[event['camera']]
+	except:
+		camera = f"camera {event.get('camera')}"
+	logger.debug(f"{reason} in {event.get('city')} at {jsonstamp} on camera {camera}")
+	return f"{reason} in {event.get('city')} at {jsonstamp} on {camera}"
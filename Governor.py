@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# This module keeps merge jobs from making the computer too busy or too hot
+# for LoadSSD, samba and filebrowser. Every GOVERNOR_INTERVAL seconds it
+# samples the load average per CPU, the CPU and I/O pressure in
+# /proc/pressure and the hottest thermal zone. If any of them is above its
+# soft limit in GOVERNOR_LIMITS, merges are throttled: at most
+# GOVERNOR_THROTTLED_WORKERS run at a time, with GOVERNOR_THROTTLED_THREADS
+# ffmpeg threads and the throttled nice and ionice settings. If any is above
+# its hard limit, no new merge starts until all of them are back below their
+# soft limits. A limit of None is not checked, and the default limits leave
+# room for the CPU use of the merges themselves. Running merges are left
+# alone. Every change is logged.
+
+import threading
+import time
+import logging
+import TCMConstants
+import SystemStatus
+import Metrics
+
+NORMAL = 0
+THROTTLED = 1
+PAUSED = 2
+LEVEL_NAMES = {NORMAL : 'normal', THROTTLED : 'throttled', PAUSED : 'paused'}
+
+level = NORMAL
+
+def get_readings():
+	# Readings that are not available on this computer are None
+	return {
+		'load' : SystemStatus.get_load_per_cpu(),
+		'cpu_pressure' : SystemStatus.get_pressure('cpu'),
+		'io_pressure' : SystemStatus.get_pressure('io'),
+		'temperature' : SystemStatus.get_temperature()
+	}
+
+def is_over(value, limit):
+	return value is not None and limit is not None and value > limit
+
+def get_level(readings, current):
+	# Returns the new level and the readings over the limits that caused it
+	over_soft = [name for name, value in readings.items() if is_over(value, TCMConstants.GOVERNOR_LIMITS[name][0])]
+	over_hard = [name for name, value in readings.items() if is_over(value, TCMConstants.GOVERNOR_LIMITS[name][1])]
+	if over_hard:
+		return PAUSED, over_hard
+	elif current == PAUSED and over_soft:
+		return PAUSED, over_soft
+	elif over_soft:
+		return THROTTLED, over_soft
+	return NORMAL, []
+
+def update():
+	# Samples the system, returns True if the level changed
+	global level
+	logger = logging.getLogger(TCMConstants.get_basename())
+	readings = get_readings()
+	new_level, reasons = get_level(readings, level)
+	for name, value in readings.items():
+		if value is not None:
+			Metrics.set_gauge('tcm_governor_reading', round(value, 2), {'reading' : name})
+	Metrics.set_gauge('tcm_governor_level', new_level)
+	if new_level == level:
+		return False
+	details = ", ".join(f"{name} {value:.2f}" for name, value in readings.items() if value is not None)
+	if reasons:
+		limits = ", ".join(f"{name} over {TCMConstants.GOVERNOR_LIMITS[name][0 if new_level == THROTTLED else 1]}" for name in reasons)
+		logger.warning(f"Merges {LEVEL_NAMES[new_level]} ({limits}): {details}")
+	else:
+		logger.info(f"Merges back to normal: {details}")
+	level = new_level
+	return True
+
+def start(on_change):
+	# Calls on_change from the governor thread whenever the level changes
+	if not TCMConstants.GOVERNOR_ENABLED:
+		return
+	update()
+	threading.Thread(target=run, args=(on_change,), name="governor", daemon=True).start()
+
+def run(on_change):
+	while True:
+		time.sleep(TCMConstants.GOVERNOR_INTERVAL)
+		try:
+			if update():
+				on_change()
+		except Exception:
+			logging.getLogger(TCMConstants.get_basename()).exception("Governor failed to sample the system")
+
+def get_worker_limit():
+	if level == PAUSED:
+		return 0
+	elif level == THROTTLED:
+		return TCMConstants.GOVERNOR_THROTTLED_WORKERS
+	return TCMConstants.MERGE_WORKERS
+
+def get_threads():
+	return TCMConstants.FFMPEG_THREADS if level == NORMAL else TCMConstants.GOVERNOR_THROTTLED_THREADS
+
+def get_command_prefix():
+	# Returns the nice and ionice commands to put in front of an ffmpeg command
+	if not TCMConstants.GOVERNOR_ENABLED:
+		return ""
+	elif level == NORMAL:
+		return f"{TCMConstants.NICE_PATH} -n {TCMConstants.GOVERNOR_NICE} {TCMConstants.IONICE_PATH} -c {TCMConstants.GOVERNOR_IONICE_CLASS} "
+	return f"{TCMConstants.NICE_PATH} -n {TCMConstants.GOVERNOR_THROTTLED_NICE} {TCMConstants.IONICE_PATH} -c {TCMConstants.GOVERNOR_THROTTLED_IONICE_CLASS} "
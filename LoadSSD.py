@@ -3,15 +3,28 @@
 # This script moves files placed in the "SHARE_PATHS" locations to the
 # "RAW_FOLDER" locations under FOOTAGE_PATH and FOOTAGE_FOLDERS for all
 # cars in CAR_LIST. I use it to pick up files placed in a CIFS share by
-# teslausb and move them to a location for merging and viewing.
+# teslausb and move them to a location for merging and viewing. Files
+# found in a loop are moved together, in batches, by Transfer.
 
 import os
 import time
-import shutil
 import re
 import json
 import TCMConstants
 import datetime
+import Watcher
+import Catalog
+import Metrics
+import Transfer
+
+moves = []	# (source, destination, sub_path, name, event, stat of source) waiting to be moved
+
+# Share directory -> (mtime, subdirectories, names still to be handled). A
+# directory is only listed again when its mtime changes; until then only the
+# names that could not be handled yet are looked at again. A directory with
+# none left is done, and costs one stat per scan.
+share_index = {}
+reported_names = set()	# paths of files with invalid names that were already reported
 
 logger = TCMConstants.get_logger()
 
@@ -23,20 +36,31 @@ def main():
 		logger.error("Missing some required permissions, exiting")
 		TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
 
+	# Only this service copies into Raw, so no copy is under way yet
+	for path in get_raw_paths():
+		Transfer.remove_temporary_files(path)
+	Metrics.start()
+	watching = TCMConstants.EVENT_DRIVEN and Watcher.start(get_share_paths(), True)
+	changes = None
+	last_scan = 0
+
 	while True:
-		for index, share in enumerate(TCMConstants.SHARE_PATHS):
-			for folder in TCMConstants.FOOTAGE_FOLDERS:
-				for root, dirs, files in os.walk(f"{share}{folder}", topdown=False):
-					for name in files:
-						if file_has_proper_name(name):
-							sub_path = folder
-							if TCMConstants.MULTI_CAR:
-								sub_path = f"{TCMConstants.CAR_LIST[index]}/{folder}"
-							move_file(os.path.join(root, name), sub_path, name)
-						elif name != "thumb.png":
-							logger.warn(f"File '{name}' has invalid name, skipping")
-
-		time.sleep(TCMConstants.SLEEP_DURATION)
+		TCMConstants.refresh_open_files()
+		if changes is None or time.time() - last_scan >= TCMConstants.RECONCILE_INTERVAL:
+			last_scan = time.time()
+			for index, share in enumerate(TCMConstants.SHARE_PATHS):
+				for folder in TCMConstants.FOOTAGE_FOLDERS:
+					scan_directory(index, folder, f"{share}{folder}")
+			Metrics.observe('tcm_scan_seconds', time.time() - last_scan, {'scan' : 'full'})
+		else:
+			scan_start = time.time()
+			for path in sorted(changes):
+				process_path(path)
+			Metrics.observe('tcm_scan_seconds', time.time() - scan_start, {'scan' : 'changes'})
+
+		move_queued_files()
+		Metrics.export()
+		changes = Watcher.wait(watching)
 
 ### Startup functions ###
 
@@ -52,26 +76,137 @@ def have_required_permissions():
 				f"{TCMConstants.FOOTAGE_PATH}{sub_path}/{TCMConstants.RAW_FOLDER}", True)
 	return have_perms
 
+def get_raw_paths():
+	paths = []
+	for index, share in enumerate(TCMConstants.SHARE_PATHS):
+		for folder in TCMConstants.FOOTAGE_FOLDERS:
+			sub_path = folder
+			if TCMConstants.MULTI_CAR:
+				sub_path = f"{TCMConstants.CAR_LIST[index]}/{folder}"
+			paths.append(f"{TCMConstants.FOOTAGE_PATH}{sub_path}/{TCMConstants.RAW_FOLDER}")
+	return paths
+
+def get_share_paths():
+	paths = []
+	for share in TCMConstants.SHARE_PATHS:
+		for folder in TCMConstants.FOOTAGE_FOLDERS:
+			paths.append(f"{share}{folder}")
+	return paths
+
 ### Loop functions ###
 
+def scan_directory(index, folder, path):
+	try:
+		mtime = os.stat(path).st_mtime_ns
+	except OSError as error:
+		logger.debug(f"Could not read {path}: {error}")
+		share_index.pop(path, None)
+		return
+	cached = share_index.get(path)
+	if cached and cached[0] == mtime:
+		subdirectories, pending = cached[1], cached[2]
+	else:
+		subdirectories = []
+		pending = set()
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					if entry.is_dir(follow_symlinks=False):
+						subdirectories.append(entry.name)
+					else:
+						pending.add(entry.name)
+		except OSError as error:
+			logger.error(f"Error listing {path}: {error}")
+			return
+		if cached:
+			for name in set(cached[1]) - set(subdirectories):
+				forget_directory(f"{path}/{name}")
+		logger.debug(f"Listed {path}: {len(pending)} files, {len(subdirectories)} directories")
+	for name in subdirectories:
+		scan_directory(index, folder, f"{path}/{name}")
+	if pending:
+		pending = {name for name in pending if not process_file(index, folder, path, name)}
+	share_index[path] = (mtime, subdirectories, pending)
+
+def forget_directory(path):
+	cached = share_index.pop(path, None)
+	if cached:
+		for name in cached[1]:
+			forget_directory(f"{path}/{name}")
+
+def requeue(file):
+	# Makes the next scan look at a file again after it failed to move
+	directory, name = os.path.split(file)
+	if directory in share_index:
+		share_index[directory][2].add(name)
+
+def process_path(path):
+	for index, share in enumerate(TCMConstants.SHARE_PATHS):
+		for folder in TCMConstants.FOOTAGE_FOLDERS:
+			if path.startswith(f"{share}{folder}/"):
+				root, name = os.path.split(path)
+				process_file(index, folder, root, name)
+				return
+	logger.debug(f"Ignoring change to {path}")
+
+def process_file(index, folder, root, name):
+	# Returns False if the file needs to be looked at again on a later scan
+	if file_has_proper_name(name):
+		sub_path = folder
+		if TCMConstants.MULTI_CAR:
+			sub_path = f"{TCMConstants.CAR_LIST[index]}/{folder}"
+		return move_file(os.path.join(root, name), sub_path, name)
+	elif name != "thumb.png" and os.path.join(root, name) not in reported_names:
+		reported_names.add(os.path.join(root, name))
+		logger.warn(f"File '{name}' has invalid name, skipping")
+	return True
+
 def move_file(file, folder, name):
+	# Returns False if the file could not be queued to move yet
 	if TCMConstants.check_file_for_read(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{name}"):
 		logger.debug(f"Destination file already exists at: {TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{name}")
+		return True
 	else:
-		logger.info(f"Moving file {file} into {folder}")
 		if TCMConstants.check_file_for_read(file):
-			destination = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}"
-			if (name == TCMConstants.EVENT_JSON):
-				with open(file, 'r') as jsonfile:
-					event = json.load(jsonfile)
-					destination += "/" + event["timestamp"].replace('T', '_').replace(':', '-') + '-' + name
+			target_name = name
+			event = None
 			try:
-				shutil.move(file, destination)
-				logger.debug(f"Moved file {file} into {folder}")
+				if (name == TCMConstants.EVENT_JSON):
+					with open(file, 'r') as jsonfile:
+						event = json.load(jsonfile)
+						target_name = event["timestamp"].replace('T', '_').replace(':', '-') + '-' + name
+				moves.append((file, f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{target_name}",
+					folder, target_name, event, os.stat(file)))
+				return True
 			except:
-				logger.error(f"Failed to move {file} into {folder}")
+				logger.error(f"Failed to read {file}, skipping")
 		else:
 			logger.debug(f"File {file} still being written, skipping for now")
+		return False
+
+def move_queued_files():
+	while moves:
+		batch = moves[:TCMConstants.TRANSFER_BATCH]
+		del moves[:TCMConstants.TRANSFER_BATCH]
+		logger.info(f"Moving {len(batch)} files")
+		start = time.time()
+		moved = Transfer.move_files([(file, destination) for file, destination, folder, name, event, info in batch])
+		total_size = 0
+		for file, destination, folder, name, event, info in batch:
+			if destination not in moved:
+				logger.error(f"Failed to move {file} into {folder}")
+				requeue(file)
+				continue
+			logger.debug(f"Moved file {file} into {folder}")
+			total_size += info.st_size
+			Metrics.increment('tcm_moved_files_total', 1, {'folder' : folder})
+			Metrics.increment('tcm_moved_bytes_total', info.st_size, {'folder' : folder})
+			Metrics.observe('tcm_share_wait_seconds', start - info.st_mtime, {'folder' : folder})
+			Catalog.record_arrival(folder, name, info.st_size)
+			if event:
+				Catalog.record_event(folder, name.rsplit("-", 1)[0], event)
+		elapsed = max(time.time() - start, 0.001)
+		logger.info(f"Moved {len(moved)} files, {TCMConstants.convert_file_size(total_size).strip()} at {TCMConstants.convert_file_size(int(total_size / elapsed)).strip()}/s")
 
 def file_has_proper_name(file):
 	if (file == TCMConstants.EVENT_JSON) or TCMConstants.FILENAME_PATTERN.match(file):
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# This module runs merge jobs for MergeTeslaCam on a pool of worker threads.
+# A job is identified by its folder and stamp. A stamp that is already
+# queued or being merged is not queued again, and the queue holds at most
+# MERGE_QUEUE_SIZE jobs. When it is full, a job of lower priority is dropped
+# to make room, or else the new job is; either way the dropped stamp is
+# picked up again on a later loop, and keeps aging from the time it was
+# first queued. Each job runs all the ffmpeg commands for its stamp in
+# order, so the fast preview of a stamp is never started before its merge
+# is done. Once a job is off the queue, the optional finisher is called
+# for its stamp, so work that must wait for a group of stamps can tell
+# reliably whether it is the last one.
+#
+# Workers pick the next job by taking turns between cars, then by the
+# priority of the footage folder in MERGE_FOLDER_PRIORITY, then by stamp
+# (newest first if MERGE_NEWEST_FIRST). A job moves up one priority level
+# for every MERGE_AGING seconds it waits, so no folder waits forever. The
+# time each job spends in the system is reported per footage folder.
+# Governor limits how many workers may run a job at the same time. The
+# encode profile in ENCODE_PROFILES follows the depth and age of the queue.
+# The waiting and running jobs are kept in a journal in STATE_PATH, and on
+# start the jobs in it are queued again right away, before any folder is
+# scanned. The journal also keeps when the dropped stamps were queued.
+
+import os
+import json
+import threading
+import time
+import logging
+import TCMConstants
+import Metrics
+import Governor
+
+JOURNAL_FILENAME = 'merge-journal.json'
+
+condition = threading.Condition()
+pending = {}				# (folder, stamp) -> time it was queued
+running = {}				# (folder, stamp) -> time it was queued
+postponed = {}				# (folder, stamp) -> time it was queued, for dropped jobs
+workers = []
+refused = False				# set when a stamp did not fit in the queue
+last_served = {}			# car -> time a job for it was last started
+latencies = {}				# footage folder -> [jobs, total seconds, longest seconds]
+profile_index = 0			# index in ENCODE_PROFILES of the profile in use
+
+def start(handler, count=TCMConstants.MERGE_WORKERS, finisher=None):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	load_journal()
+	for index in range(max(1, count)):
+		worker = threading.Thread(target=run_worker, args=(handler, finisher),
+			name=f"merge-{index}", daemon=True)
+		worker.start()
+		workers.append(worker)
+	logger.info(f"Started {len(workers)} merge workers")
+	Governor.start(wake_workers)
+
+def wake_workers():
+	with condition:
+		condition.notify_all()
+
+def submit(folder, stamp, queued=None):
+	global refused
+	key = (folder, stamp)
+	with condition:
+		if key in pending or key in running:
+			logging.getLogger(TCMConstants.get_basename()).debug(
+				f"Stamp {stamp} in {folder} already queued, skipping")
+			return True
+		# A stamp that was dropped before keeps aging from when it was first queued
+		queued = min(queued or time.time(), postponed.pop(key, time.time()))
+		if len(pending) >= TCMConstants.MERGE_QUEUE_SIZE:
+			# Make room by postponing a job of lower priority, if there is one
+			now = time.time()
+			worst = max(pending, key=lambda job: get_priority(job[0], pending[job], now))
+			refused = True
+			if get_priority(folder, queued, now) >= get_priority(worst[0], pending[worst], now):
+				logging.getLogger(TCMConstants.get_basename()).debug(
+					f"Merge queue full, postponing {stamp} in {folder}")
+				postponed[key] = queued
+				return False
+			logging.getLogger(TCMConstants.get_basename()).debug(
+				f"Merge queue full, postponing {worst[1]} in {worst[0]} for {stamp} in {folder}")
+			postponed[worst] = pending.pop(worst)
+		pending[key] = queued
+		save_journal()
+		condition.notify()
+		return True
+
+def is_queued(folder, stamp):
+	with condition:
+		return (folder, stamp) in pending or (folder, stamp) in running
+
+def get_queued(folder):
+	with condition:
+		return {stamp for queued_folder, stamp in list(pending) + list(running) if queued_folder == folder}
+
+def run_worker(handler, finisher):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	while True:
+		with condition:
+			while not pending or len(running) >= Governor.get_worker_limit():
+				condition.wait()
+			key = choose_next_job()
+			queued = pending.pop(key)
+			running[key] = queued
+			save_journal()
+			last_served[get_car(key[0])] = time.time()
+		folder, stamp = key
+		try:
+			handler(folder, stamp)
+		except Exception:
+			logger.exception(f"Merge job failed for {stamp} in {folder}")
+		finally:
+			with condition:
+				del running[key]
+				save_journal()
+				record_latency(folder, time.time() - queued)
+				condition.notify()
+		logger.debug(f"Finished {stamp} in {folder} after {time.time() - queued:.0f}s in the system")
+		if finisher:
+			try:
+				finisher(folder, stamp)
+			except Exception:
+				logger.exception(f"Finishing {stamp} in {folder} failed")
+
+### Journal functions ###
+
+def get_journal_path():
+	return f"{TCMConstants.STATE_PATH}{JOURNAL_FILENAME}"
+
+def load_journal():
+	# Queues the jobs that were waiting or running when the service stopped
+	logger = logging.getLogger(TCMConstants.get_basename())
+	try:
+		with open(get_journal_path(), "r") as file:
+			journal = json.load(file)
+		if isinstance(journal, list):
+			journal = {"jobs" : journal, "postponed" : []}
+		jobs = journal["jobs"]
+		with condition:
+			for folder, stamp, queued in journal["postponed"]:
+				postponed[(folder, stamp)] = queued
+	except FileNotFoundError:
+		return
+	except (OSError, ValueError, KeyError, TypeError) as error:
+		logger.error(f"Error reading merge journal {get_journal_path()}: {error}")
+		return
+	for folder, stamp, queued in sorted(jobs, key=lambda job: job[2]):
+		submit(folder, stamp, queued)
+	if jobs:
+		logger.info(f"Resuming {len(jobs)} merge jobs from the journal")
+
+def save_journal():
+	# Called with condition held. Dropped stamps that are not submitted again
+	# within DAYS_TO_KEEP days have been deleted, so they are forgotten.
+	expired = time.time() - TCMConstants.DAYS_TO_KEEP * 86400
+	for key in [key for key, queued in postponed.items() if queued < expired]:
+		del postponed[key]
+	journal = {
+		"jobs" : [[folder, stamp, queued] for (folder, stamp), queued in list(running.items()) + list(pending.items())],
+		"postponed" : [[folder, stamp, queued] for (folder, stamp), queued in postponed.items()]
+	}
+	try:
+		os.makedirs(TCMConstants.STATE_PATH, exist_ok=True)
+		with open(f"{get_journal_path()}.tmp", "w") as file:
+			json.dump(journal, file)
+		os.replace(f"{get_journal_path()}.tmp", get_journal_path())
+	except OSError as error:
+		logging.getLogger(TCMConstants.get_basename()).error(f"Error saving merge journal {get_journal_path()}: {error}")
+
+def get_car(folder):
+	return folder.rpartition("/")[0]
+
+def get_priority(folder, queued, now):
+	footage_folder = folder.rpartition("/")[2]
+	priority = TCMConstants.MERGE_FOLDER_PRIORITY.get(footage_folder, len(TCMConstants.MERGE_FOLDER_PRIORITY))
+	return priority - int((now - queued) // TCMConstants.MERGE_AGING)
+
+def choose_next_job():
+	# Called with condition held and at least one job pending
+	now = time.time()
+	cars = {get_car(folder) for folder, stamp in pending}
+	car = min(cars, key=lambda car: last_served.get(car, 0))
+	jobs = [(get_priority(folder, queued, now), folder, stamp) for (folder, stamp), queued in pending.items() if get_car(folder) == car]
+	best = min(job[0] for job in jobs)
+	candidates = [(stamp, folder) for priority, folder, stamp in jobs if priority == best]
+	if TCMConstants.MERGE_NEWEST_FIRST:
+		stamp, folder = max(candidates)
+	else:
+		stamp, folder = min(candidates)
+	return (folder, stamp)
+
+def record_latency(folder, seconds):
+	# Called with condition held
+	footage_folder = folder.rpartition("/")[2]
+	stats = latencies.setdefault(footage_folder, [0, 0, 0])
+	stats[0] += 1
+	stats[1] += seconds
+	stats[2] = max(stats[2], seconds)
+
+def get_encode_profile():
+	# Returns the (name, stamps, seconds, preset, crf) profile for a job starting now
+	global profile_index
+	logger = logging.getLogger(TCMConstants.get_basename())
+	with condition:
+		backlog = len(pending) + len(running)
+		age = time.time() - min(list(pending.values()) + list(running.values()), default=time.time())
+		profiles = TCMConstants.ENCODE_PROFILES
+		index = min(profile_index, len(profiles) - 1)
+		reached = max(position for position, (name, stamps, seconds, preset, crf) in enumerate(profiles)
+			if position == 0 or backlog >= stamps or age >= seconds)
+		if reached > index:
+			index = reached
+		elif index > 0 and backlog < profiles[index][1] / 2 and age < profiles[index][2] / 2:
+			index -= 1
+		if index != profile_index:
+			logger.info(f"Switching to encode profile {profiles[index][0]}: {backlog} stamps waiting, oldest for {age:.0f}s")
+			profile_index = index
+		return profiles[index]
+
+def get_queue_depth():
+	with condition:
+		return len(pending), len(running)
+
+def get_oldest_pending():
+	with condition:
+		jobs = list(pending.items()) + list(running.items())
+	if jobs:
+		key, queued = min(jobs, key=lambda job: job[1])
+		return key[0], key[1], time.time() - queued
+	else:
+		return None, None, 0
+
+def report():
+	logger = logging.getLogger(TCMConstants.get_basename())
+	queued, active = get_queue_depth()
+	folder, stamp, age = get_oldest_pending()
+	Metrics.set_gauge('tcm_merge_queue_jobs', queued, {'state' : 'waiting'})
+	Metrics.set_gauge('tcm_merge_queue_jobs', active, {'state' : 'running'})
+	Metrics.set_gauge('tcm_merge_oldest_job_seconds', round(age))
+	if queued or active:
+		logger.info(f"Merge queue: {queued} waiting, {active} running, oldest {stamp} in {folder} waiting {age:.0f}s")
+	else:
+		logger.debug("Merge queue is empty")
+	with condition:
+		finished = dict(latencies)
+		latencies.clear()
+	for footage_folder, (jobs, total, longest) in sorted(finished.items()):
+		logger.info(f"Merged {jobs} stamps in {footage_folder}, latency average {total / jobs:.0f}s, longest {longest:.0f}s")
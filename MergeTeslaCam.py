@@ -4,25 +4,65 @@
 # It looks for files at "RAW_PATH" and waits for all (front, left-repeater,
 # right-repeater, and back) are available for a single timestamp. Once all 
 # four files are available, it merges them into one "full" file. It then
-# creates a sped-up view of the "full" file as the "fast" file.
+# creates a sped-up view of the "full" file as the "fast" file. Timestamps
+# that are ready are handed to MergeScheduler, which runs up to
+# MERGE_WORKERS of them at the same time. If EVENT_COMPILATIONS is True,
+# the full and fast videos of the stamps around each event are then joined
+# into one "event-full" and one "event-fast" video without re-encoding.
+# ffmpeg writes each video to a hidden temporary file that is renamed once
+# it is complete, so a merge that is interrupted leaves nothing behind that
+# looks finished.
 
 import os
 import time
-import subprocess
+import atexit
+import tempfile
+import threading
 import datetime
 import TCMConstants
 import re
-import logging
-import json
+import MergeScheduler
+import Watcher
+import Catalog
+import BadFiles
+import EventIndex
+import Metrics
+import Governor
 
 # ffmpeg commands and filters
 ffmpeg_base = f'{TCMConstants.FFMPEG_PATH} -hide_banner -loglevel error -timelimit {TCMConstants.FFMPEG_TIMELIMIT}'
-ffmpeg_mid_full = f'-filter_complex "[1:v]scale=w={TCMConstants.FRONT_WIDTH}:h={TCMConstants.FRONT_HEIGHT}[top];[0:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[right];[3:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[back];[2:v]scale=w={TCMConstants.REST_WIDTH}:h={TCMConstants.REST_HEIGHT}[left];[left][back][right]hstack=inputs=3[bottom];[top][bottom]vstack=inputs=2[full];[full]drawtext=text=\''
+ffmpeg_scale = 'scale=w={0}:h={1}{2}'
+ffmpeg_mid_full = '-filter_complex "[1:v]{top}[top];[0:v]{rest}[right];[3:v]{rest}[back];[2:v]{rest}[left];[left][back][right]hstack=inputs=3[bottom];[top][bottom]vstack=inputs=2[full];[full]drawtext=text=\''
 ffmpeg_mid2_full = '\':fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=(w-text_w)/2[labeled];[labeled]drawtext=text=\''
-ffmpeg_end_full = '\':fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=(w-text_w)/2:y=h-text_h" -movflags +faststart -threads 0'
-ffmpeg_end_fast = '-vf "setpts=0.09*PTS" -c:v libx264 -crf 28 -profile:v main -tune fastdecode -movflags +faststart -threads 0'
+ffmpeg_end_full = '\':fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=(w-text_w)/2:y=h-text_h" {full_encoder} -movflags +faststart -threads {threads}'
+ffmpeg_end_both = '\':fontcolor=white:fontsize=24:box=1:boxcolor=black@0.5:boxborderw=5:x=(w-text_w)/2:y=h-text_h,split=2[fullout][fastin];[fastin]{both_fast_filter}[fastout]" -map "[fullout]" {full_encoder} -movflags +faststart -threads {threads}'
+ffmpeg_end_both_fast = '-map "[fastout]" {fast_encoder} -movflags +faststart -threads {threads}'
+ffmpeg_end_fast = '-vf "{fast_filter}" {fast_encoder} -movflags +faststart -threads {threads}'
+ffmpeg_fast_retime = 'setpts={0}*PTS'
+ffmpeg_fast_stride = 'select=\'not(mod(n,{0}))\',setpts=N/FRAME_RATE/TB'
+ffmpeg_fast_keyframe = '-skip_frame nokey'
+ffmpeg_fast_scale = 'scale=w={0}:h=-2{1}'
+ffmpeg_concat = '-f concat -safe 0 -i {0} -c copy -movflags +faststart'
 ffmpeg_error_regex = '(.*): Invalid data found when processing input'
 ffmpeg_error_pattern = re.compile(ffmpeg_error_regex)
+VIDEO_TYPE_LABELS = {0 : 'full', 1 : 'fast', 2 : 'both'}
+FAST_PTS_FACTOR = 0.09	# fast previews play about 11 times faster than the full videos
+
+camera_texts = frozenset([TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.RIGHT_TEXT, TCMConstants.BACK_TEXT])
+
+# Raw folder -> (folder mtime, {stamp: (files seen for the stamp, done)}).
+# A stamp is done when nothing more can happen to it until its files change.
+raw_index = {}
+# Raw folder -> stamps the catalog says are already merged or bad
+settled_stamps = {}
+# Held while an event compilation is checked and made, so two workers
+# finishing stamps of the same event do not both write it
+compilation_lock = threading.Lock()
+# (folder, event stamp) -> name of the encode profile for the stamps of the
+# event. Videos made with different x264 presets cannot be joined without
+# re-encoding, so all the stamps of an event use the same profile.
+event_profiles = {}
+profile_lock = threading.Lock()
 
 logger = TCMConstants.get_logger()
 
@@ -31,15 +71,36 @@ def main():
 		logger.error("Missing some required permissions, exiting")
 		TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
 
+	atexit.register(BadFiles.export, True)
+	remove_orphaned_outputs()
+	MergeScheduler.start(merge_stamp, finisher=finish_stamp)
+	Metrics.start()
+	watching = TCMConstants.EVENT_DRIVEN and Watcher.start(get_raw_paths())
+	changes = None
+	last_scan = 0
+
 	while True:
 		logger.debug("Starting new iteration")
-		if TCMConstants.MULTI_CAR:
-			for car in TCMConstants.CAR_LIST:
-				loop_car(f"{car}/")
+		TCMConstants.refresh_open_files()
+		if changes is None or MergeScheduler.refused or time.time() - last_scan >= TCMConstants.RECONCILE_INTERVAL:
+			MergeScheduler.refused = False
+			last_scan = time.time()
+			if TCMConstants.MULTI_CAR:
+				for car in TCMConstants.CAR_LIST:
+					loop_car(f"{car}/")
+			else:
+				loop_car("")
+			Metrics.observe('tcm_scan_seconds', time.time() - last_scan, {'scan' : 'full'})
 		else:
-			loop_car("")
+			scan_start = time.time()
+			for path in changes:
+				process_path(path)
+			Metrics.observe('tcm_scan_seconds', time.time() - scan_start, {'scan' : 'changes'})
 
-		time.sleep(TCMConstants.SLEEP_DURATION)
+		BadFiles.export()
+		MergeScheduler.report()
+		Metrics.export()
+		changes = Watcher.wait(watching)
 
 ### Startup functions ###
 
@@ -60,38 +121,166 @@ def check_permissions_for_car(car_path):
 		have_perms = have_perms and TCMConstants.check_permissions(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.FAST_FOLDER}", True)
 	return have_perms
 
+def remove_orphaned_outputs():
+	# No job runs yet, so every hidden output is left over from a job that
+	# was interrupted, and resumed jobs make theirs again from the start
+	for path in get_raw_paths():
+		folder_path = path[:-len(TCMConstants.RAW_FOLDER)]
+		for kind, text in [(TCMConstants.FULL_FOLDER, TCMConstants.FULL_TEXT), (TCMConstants.FAST_FOLDER, TCMConstants.FAST_TEXT)]:
+			try:
+				names = os.listdir(f"{folder_path}{kind}")
+			except OSError as error:
+				logger.error(f"Error listing {folder_path}{kind}: {error}")
+				continue
+			for name in names:
+				if name.startswith(".") and name.endswith(f"-{text}"):
+					try:
+						os.remove(f"{folder_path}{kind}/{name}")
+						logger.info(f"Removed unfinished video {folder_path}{kind}/{name}")
+					except OSError as error:
+						logger.warning(f"Failed to remove unfinished video {folder_path}{kind}/{name}: {error}")
+
+def get_raw_paths():
+	paths = []
+	for folder in TCMConstants.FOOTAGE_FOLDERS:
+		if TCMConstants.MULTI_CAR:
+			for car in TCMConstants.CAR_LIST:
+				paths.append(f"{TCMConstants.FOOTAGE_PATH}{car}/{folder}/{TCMConstants.RAW_FOLDER}")
+		else:
+			paths.append(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}")
+	return paths
+
 ### Loop functions ###
 
 def loop_car(car_path):
 	for folder in TCMConstants.FOOTAGE_FOLDERS:
-		raw_files = os.listdir(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.RAW_FOLDER}")
-		for file in raw_files:
-			logger.debug(f"Starting with file {file}")
-			try:
-				stamp, camera = file.rsplit("-", 1)
-			except ValueError:
-				if TCMConstants.EVENT_JSON not in file and file != TCMConstants.BAD_VIDEOS_FILENAME and file != TCMConstants.BAD_SIZES_FILENAME:
-					logger.warning(f"Unrecognized filename: {file}")
-				continue
-			process_stamp(stamp, f"{car_path}{folder}")
+		sub_path = f"{car_path}{folder}"
+		raw_path = f"{TCMConstants.FOOTAGE_PATH}{sub_path}/{TCMConstants.RAW_FOLDER}"
+		mtime = os.stat(raw_path).st_mtime_ns
+		previous_mtime, previous = raw_index.get(sub_path, (None, {}))
+		if mtime == previous_mtime:
+			stamps = {stamp: files for stamp, (files, done) in previous.items()}
+		else:
+			stamps = get_raw_stamps(raw_path)
+			EventIndex.update(sub_path, [stamp for stamp, files in stamps.items() if TCMConstants.EVENT_JSON in files])
+		if sub_path not in settled_stamps:
+			settled_stamps[sub_path] = Catalog.get_settled_stamps(sub_path)
+			logger.info(f"Catalog has {len(settled_stamps[sub_path])} settled stamps in {sub_path}")
+		index = {}
+		outputs = None
+		for stamp, files in stamps.items():
+			known = previous.get(stamp)
+			if known and known[0] == files and known[1]:
+				index[stamp] = known
+			elif not known and stamp in settled_stamps[sub_path]:
+				if outputs is None:
+					outputs = get_output_stamps(sub_path)
+				if is_still_settled(stamp, sub_path, outputs):
+					index[stamp] = (files, True)
+				else:
+					logger.info(f"Catalog entry for {stamp} in {sub_path} does not match the files any more, checking it again")
+					settled_stamps[sub_path].discard(stamp)
+					Catalog.clear_settled(sub_path, stamp, stamp in outputs[0], stamp in outputs[1])
+					index[stamp] = (files, process_stamp(stamp, sub_path))
+			elif not camera_texts <= files:
+				logger.debug(f"Stamp {stamp} in {sub_path} does not have all cameras yet")
+				index[stamp] = (files, True)
+			else:
+				index[stamp] = (files, process_stamp(stamp, sub_path))
+		raw_index[sub_path] = (mtime, index)
+
+def get_output_stamps(folder):
+	# Returns the sets of stamps that have a full and a fast video
+	outputs = []
+	for kind, text in [(TCMConstants.FULL_FOLDER, TCMConstants.FULL_TEXT), (TCMConstants.FAST_FOLDER, TCMConstants.FAST_TEXT)]:
+		try:
+			names = os.listdir(f"{TCMConstants.FOOTAGE_PATH}{folder}/{kind}")
+		except OSError as error:
+			logger.error(f"Error listing {kind} videos in {folder}: {error}")
+			names = []
+		outputs.append({name[:-len(text) - 1] for name in names if name.endswith(f"-{text}") and not name.startswith(".")})
+	return outputs
+
+def is_still_settled(stamp, folder, outputs):
+	# The catalog is only a shortcut: the outputs must still be there, or
+	# the stamp still listed as bad, for it to need no more work
+	if stamp in outputs[0] and stamp in outputs[1]:
+		return True
+	if BadFiles.contains(folder, TCMConstants.BAD_SIZES_FILENAME, stamp):
+		return True
+	return any(BadFiles.contains(folder, TCMConstants.BAD_VIDEOS_FILENAME, f"{stamp}-{item}") for item in camera_texts)
+
+def get_raw_stamps(raw_path):
+	stamps = {}
+	for file in os.listdir(raw_path):
+		logger.debug(f"Starting with file {file}")
+		if file.startswith("."):
+			continue
+		try:
+			stamp, camera = file.rsplit("-", 1)
+		except ValueError:
+			if TCMConstants.EVENT_JSON not in file and file != TCMConstants.BAD_VIDEOS_FILENAME and file != TCMConstants.BAD_SIZES_FILENAME:
+				logger.warning(f"Unrecognized filename: {file}")
+			continue
+		stamps.setdefault(stamp, set()).add(camera)
+	return {stamp: frozenset(files) for stamp, files in stamps.items()}
+
+def process_path(path):
+	directory, file = os.path.split(path)
+	try:
+		stamp, camera = file.rsplit("-", 1)
+	except ValueError:
+		logger.debug(f"Ignoring change to {path}")
+		return
+	if file.startswith("."):
+		logger.debug(f"Ignoring change to temporary file {path}")
+		return
+	folder = directory[len(TCMConstants.FOOTAGE_PATH):-len(TCMConstants.RAW_FOLDER) - 1]
+	if camera == TCMConstants.EVENT_JSON:
+		EventIndex.add(folder, stamp)
+	else:
+		process_stamp(stamp, folder)
 
 def process_stamp(stamp, folder):
+	# Returns True if nothing more can be done for the stamp until its files change
 	logger.debug(f"Processing stamp {stamp} in {folder}")
-	if stamp_is_all_ready(stamp, folder):
+	if MergeScheduler.is_queued(folder, stamp):
+		logger.debug(f"Stamp {stamp} in {folder} is already queued")
+		return False
+	elif not (TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}") or TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}")):
+		logger.debug(f"Full and fast files exist for stamp {stamp} at {folder}")
+		return True
+	elif stamp_is_all_ready(stamp, folder):
 		logger.debug(f"Stamp {stamp} in {folder} is ready to go")
-		if TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"):
-			run_ffmpeg_command("Merge", folder, stamp, 0)
-		else:
-			logger.debug(f"Full file exists for stamp {stamp}")
-		if TCMConstants.check_file_for_read(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"):
-			if TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"):
-				run_ffmpeg_command("Fast preview", folder, stamp, 1)
-			else:
-				logger.debug(f"Fast file exists for stamp {stamp} at {folder}")
-		else:
-			logger.warning(f"Full file {TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT} not ready for read, postponing fast preview")
+		MergeScheduler.submit(folder, stamp)
+		return False
 	else:
 		logger.debug(f"Stamp {stamp} not yet ready in {folder}")
+		return not stamp_files_pending(stamp, folder)
+
+def finish_stamp(folder, stamp):
+	# Runs after the stamp has left the merge queue, so the last stamp of
+	# an event to finish never sees the others as still merging
+	if TCMConstants.EVENT_COMPILATIONS:
+		compile_event(folder, stamp)
+
+def merge_stamp(folder, stamp):
+	if TCMConstants.SINGLE_PASS_MERGE and TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}") and TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"):
+		run_ffmpeg_command("Merge and fast preview", folder, stamp, 2)
+		return
+	merged = False
+	if TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"):
+		merged = run_ffmpeg_command("Merge", folder, stamp, 0)
+	else:
+		logger.debug(f"Full file exists for stamp {stamp}")
+	# A full file this worker just made is complete, whatever its mtime
+	if merged or TCMConstants.check_file_for_read(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT}"):
+		if TCMConstants.check_file_for_write(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FAST_FOLDER}/{stamp}-{TCMConstants.FAST_TEXT}"):
+			run_ffmpeg_command("Fast preview", folder, stamp, 1)
+		else:
+			logger.debug(f"Fast file exists for stamp {stamp} at {folder}")
+	else:
+		logger.warning(f"Full file {TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}/{stamp}-{TCMConstants.FULL_TEXT} not ready for read, postponing fast preview")
 
 def stamp_is_all_ready(stamp, folder):
 	front_file = f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{TCMConstants.FRONT_TEXT}"
@@ -105,18 +294,18 @@ def stamp_is_all_ready(stamp, folder):
 	else:
 		return False
 
+def stamp_files_pending(stamp, folder):
+	for item in camera_texts:
+		if not TCMConstants.check_file_for_read(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{item}"):
+			return True
+	return False
+
 def file_is_bad(stamp, folder):
-	if TCMConstants.check_file_for_read(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_VIDEOS_FILENAME}"):
-		with open(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_VIDEOS_FILENAME}", "r") as f:
-			bad_names = f.readlines()
-			check_list = [TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.RIGHT_TEXT, TCMConstants.BACK_TEXT]
-			for item in check_list:
-				if f"{stamp}-{item}\n" in bad_names:
-					logger.debug(f"Skipping {stamp} in {folder} due to bad data in {stamp}-{item}")
-					return True
-			return False
-	else:
-		return False
+	for item in camera_texts:
+		if BadFiles.contains(folder, TCMConstants.BAD_VIDEOS_FILENAME, f"{stamp}-{item}"):
+			logger.debug(f"Skipping {stamp} in {folder} due to bad data in {stamp}-{item}")
+			return True
+	return False
 
 def file_sizes_in_same_range(folder, stamp, front_file, left_file, right_file, back_file):
 	front_size = os.path.getsize(front_file)
@@ -141,17 +330,120 @@ def file_sizes_in_same_range(folder, stamp, front_file, left_file, right_file, b
 		else:
 			return True
 
+### Event compilation functions ###
+
+def get_member_profiles(folder, event_stamp):
+	# Returns {stamp: (full profile, fast profile)} the catalog has for the stamps of an event
+	event_time = EventIndex.parse_stamp(event_stamp)
+	window = datetime.timedelta(seconds=TCMConstants.EVENT_DURATION)
+	profiles = Catalog.get_output_profiles(folder, (event_time - window).strftime(TCMConstants.FILENAME_TIMESTAMP_FORMAT),
+		(event_time + window).strftime(TCMConstants.FILENAME_TIMESTAMP_FORMAT))
+	return {member: names for member, names in profiles.items() if EventIndex.find(folder, member) == event_stamp}
+
+def get_event_profile(folder, stamp):
+	# Returns the encode profile for the stamp, the same one as for the rest of its event
+	profile = MergeScheduler.get_encode_profile()
+	event_stamp = EventIndex.find(folder, stamp) if TCMConstants.EVENT_COMPILATIONS else None
+	if event_stamp is None:
+		return profile
+	with profile_lock:
+		if (folder, event_stamp) not in event_profiles:
+			# After a restart, carry on with the profile most of the event's videos already have
+			recorded = [full for full, fast in get_member_profiles(folder, event_stamp).values() if full]
+			event_profiles[(folder, event_stamp)] = max(recorded, key=recorded.count) if recorded else profile[0]
+		name = event_profiles[(folder, event_stamp)]
+	if name != profile[0]:
+		logger.debug(f"Using encode profile {name} of event {event_stamp} for {stamp} in {folder}")
+	return next((candidate for candidate in TCMConstants.ENCODE_PROFILES if candidate[0] == name), profile)
+
+def compile_event(folder, stamp):
+	event_stamp = EventIndex.find(folder, stamp)
+	if event_stamp is None:
+		return
+	# Whichever stamp of the event leaves the queue last compiles it
+	if any(EventIndex.find(folder, queued) == event_stamp for queued in MergeScheduler.get_queued(folder)):
+		logger.debug(f"Stamps of event {event_stamp} in {folder} are still merging, postponing compilation")
+		return
+	try:
+		names = os.listdir(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.FULL_FOLDER}")
+	except OSError as error:
+		logger.error(f"Error listing full videos in {folder}: {error}")
+		return
+	members = sorted(name[:-len(TCMConstants.FULL_TEXT) - 1] for name in names
+		if name.endswith(f"-{TCMConstants.FULL_TEXT}") and not name.startswith(".")
+		and EventIndex.find(folder, name[:-len(TCMConstants.FULL_TEXT) - 1]) == event_stamp)
+	recorded = get_member_profiles(folder, event_stamp)
+	with compilation_lock:
+		for index, kind, text, event_text in [(0, TCMConstants.FULL_FOLDER, TCMConstants.FULL_TEXT, TCMConstants.EVENT_FULL_TEXT),
+				(1, TCMConstants.FAST_FOLDER, TCMConstants.FAST_TEXT, TCMConstants.EVENT_FAST_TEXT)]:
+			path = f"{TCMConstants.FOOTAGE_PATH}{folder}/{kind}"
+			# Finished outputs are renamed into place by this process, so they are complete once they exist
+			present = [member for member in members if os.path.isfile(f"{path}/{member}-{text}")]
+			inputs = [f"{path}/{member}-{text}" for member in present]
+			output = f"{path}/{event_stamp}-{event_text}"
+			if len(inputs) < 2:
+				continue
+			profiles = {recorded[member][index] for member in present if member in recorded and recorded[member][index]}
+			if len(profiles) > 1:
+				logger.warning(f"Not compiling {output}: its videos were encoded with different profiles ({', '.join(sorted(profiles))})")
+				continue
+			if os.path.isfile(output) and os.path.getmtime(output) >= max(os.path.getmtime(file) for file in inputs):
+				logger.debug(f"Compilation {output} is up to date")
+				continue
+			run_concat_command(folder, event_stamp, inputs, output)
+
+def run_concat_command(folder, event_stamp, inputs, output):
+	logger.info(f"Compiling {len(inputs)} videos into {output}...")
+	temporary = os.path.join(os.path.dirname(output), f".{os.path.basename(output)}")
+	with tempfile.NamedTemporaryFile("w", prefix="tcm-concat-", suffix=".txt") as list_file:
+		list_file.write("".join("file '{0}'\n".format(file.replace("'", "'\\''")) for file in inputs))
+		list_file.flush()
+		command = f"{Governor.get_command_prefix()}{ffmpeg_base} -y {ffmpeg_concat.format(list_file.name)} {temporary}"
+		logger.debug(f"Command: {command}")
+		completed = TCMConstants.run_timed(command)
+	labels = {'folder' : folder, 'type' : 'event'}
+	Metrics.observe('tcm_ffmpeg_wall_seconds', completed.wall_time, labels)
+	Metrics.observe('tcm_ffmpeg_cpu_seconds', completed.cpu_time, labels)
+	if completed.stderr or completed.returncode != 0:
+		logger.error(f"Error running ffmpeg command: {command}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+		Metrics.increment('tcm_ffmpeg_failures_total', 1, labels)
+		if os.path.isfile(temporary):
+			os.remove(temporary)
+		return
+	os.replace(temporary, output)
+	logger.info(f"Compilation completed: {output}.")
+
 ### FFMPEG command functions ###
 
 def run_ffmpeg_command(log_text, folder, stamp, video_type):
-	logger.info(f"{log_text} started in {stamp}: {folder}...")
-	command = get_ffmpeg_command(folder, stamp, video_type)
+	# Returns True if ffmpeg succeeded and its outputs are in place
+	profile, stamps, seconds, preset, crf = get_event_profile(folder, stamp)
+	logger.info(f"{log_text} started in {stamp}: {folder} with encode profile {profile}...")
+	overrides = {
+		"full_encoder" : f"{TCMConstants.FFMPEG_FULL_ENCODER} -preset {preset} -crf {crf}",
+		"fast_encoder" : f"{TCMConstants.FFMPEG_FAST_ENCODER} -preset {preset}"
+	}
+	outputs = [output for output, types in [('full', [0, 2]), ('fast', [1, 2])] if video_type in types]
+	remove_temporary_outputs(folder, stamp, outputs)
+	command = Governor.get_command_prefix() + get_ffmpeg_command(folder, stamp, video_type, overrides, temporary=True)
 	logger.debug(f"Command: {command}")
-	completed = subprocess.run(command, shell=True,
-		stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE)
+	completed = TCMConstants.run_timed(command)
+	succeeded = completed.returncode == 0
+	if succeeded:
+		for output in outputs:
+			try:
+				os.replace(get_output_path(folder, stamp, output, True), get_output_path(folder, stamp, output))
+			except OSError as error:
+				logger.error(f"Failed to move {output} video for {stamp} in {folder} into place: {error}")
+				succeeded = False
+	else:
+		remove_temporary_outputs(folder, stamp, outputs)
+	labels = {'folder' : folder, 'type' : VIDEO_TYPE_LABELS[video_type], 'profile' : profile}
+	Metrics.observe('tcm_ffmpeg_wall_seconds', completed.wall_time, labels)
+	Metrics.observe('tcm_ffmpeg_cpu_seconds', completed.cpu_time, labels)
 	if completed.stderr or completed.returncode != 0:
 		logger.error(f"Error running ffmpeg command: {command}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+		Metrics.increment('tcm_ffmpeg_failures_total', 1, labels)
 		for line in completed.stderr.decode("UTF-8").splitlines():
 			match = ffmpeg_error_pattern.match(line)
 			if match:
@@ -166,19 +458,92 @@ def run_ffmpeg_command(log_text, folder, stamp, video_type):
 					add_to_bad_videos(folder, file)
 	else:
 		logger.debug(f"FFMPEG stdout: {completed.stdout}, stderr: {completed.stderr}")
+		Catalog.record_output(folder, stamp, full=video_type in [0, 2], fast=video_type in [1, 2], profile=profile)
+		record_arrival_latency(folder, stamp, video_type)
 	logger.info(f"{log_text} completed: {stamp}.")
+	return succeeded
 
-def get_ffmpeg_command(folder, stamp, video_type):
+def remove_temporary_outputs(folder, stamp, outputs):
+	# Removes what an interrupted or failed ffmpeg command left behind
+	for output in outputs:
+		try:
+			os.remove(get_output_path(folder, stamp, output, True))
+			logger.debug(f"Removed unfinished {output} video for {stamp} in {folder}")
+		except FileNotFoundError:
+			pass
+		except OSError as error:
+			logger.warning(f"Failed to remove unfinished {output} video for {stamp} in {folder}: {error}")
+
+def record_arrival_latency(folder, stamp, video_type):
+	# LoadSSD moving a camera file into Raw sets its ctime, so the latest
+	# ctime of the four files is when the stamp became ready to merge
+	try:
+		arrived = max(os.stat(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{stamp}-{camera}").st_ctime
+			for camera in camera_texts)
+	except OSError:
+		return
+	for output, types in [('full', [0, 2]), ('fast', [1, 2])]:
+		if video_type in types:
+			Metrics.observe('tcm_arrival_to_output_seconds', time.time() - arrived, {'folder' : folder, 'output' : output})
+
+def get_encoder_settings(overrides=None):
+	settings = {
+		"front_width" : TCMConstants.FRONT_WIDTH,
+		"scaler" : TCMConstants.FFMPEG_SCALER_FLAGS,
+		"full_encoder" : TCMConstants.FFMPEG_FULL_ENCODER,
+		"fast_encoder" : TCMConstants.FFMPEG_FAST_ENCODER,
+		"threads" : Governor.get_threads(),
+		"fast_mode" : TCMConstants.FAST_PREVIEW_MODE,
+		"fast_width" : TCMConstants.FAST_PREVIEW_WIDTH
+	}
+	if overrides:
+		settings.update(overrides)
+	width = settings["front_width"]
+	flags = f":flags={settings['scaler']}" if settings["scaler"] else ""
+	settings["top"] = ffmpeg_scale.format(width, width*3/4, flags)
+	settings["rest"] = ffmpeg_scale.format(width/3, width*3/4/3, flags)
+	settings["fast_input"], settings["fast_filter"], settings["both_fast_filter"] = get_fast_filters(settings, flags)
+	return settings
+
+def get_fast_filters(settings, flags):
+	# Returns the input options and filter for a fast preview made from the
+	# full video, and the filter for one made in the same pass as the full
+	# video. Keyframes only exist in an encoded file, so the single pass
+	# merge uses the stride in keyframe mode.
+	retime = ffmpeg_fast_retime.format(FAST_PTS_FACTOR)
+	stride = ffmpeg_fast_stride.format(round(1 / FAST_PTS_FACTOR))
+	scale = f",{ffmpeg_fast_scale.format(settings['fast_width'], flags)}" if settings["fast_width"] else ""
+	if settings["fast_mode"] == 'keyframe':
+		return ffmpeg_fast_keyframe, f"{retime}{scale}", f"{stride}{scale}"
+	elif settings["fast_mode"] == 'stride':
+		return "", f"{stride}{scale}", f"{stride}{scale}"
+	return "", f"{retime}{scale}", f"{retime}{scale}"
+
+def get_output_path(folder, stamp, output, temporary=False):
+	# Temporary outputs are hidden, so nothing picks them up before they are done
+	kind, text = (TCMConstants.FULL_FOLDER, TCMConstants.FULL_TEXT) if output == 'full' else (TCMConstants.FAST_FOLDER, TCMConstants.FAST_TEXT)
+	return f"{TCMConstants.FOOTAGE_PATH}{folder}/{kind}/{'.' if temporary else ''}{stamp}-{text}"
+
+def get_ffmpeg_command(folder, stamp, video_type, overrides=None, temporary=False):
 	logger.debug(f"Get command: folder {folder}, stamp {stamp}, type {video_type}")
+	settings = get_encoder_settings(overrides)
+	full_output = get_output_path(folder, stamp, 'full', temporary)
+	fast_output = get_output_path(folder, stamp, 'fast', temporary)
 	if video_type == 0:
-		command = "{0} -i {1}{2}/{3}/{4}-{5} -i {1}{2}/{3}/{4}-{6} -i {1}{2}/{3}/{4}-{7} -i {1}{2}/{3}/{4}-{8} {9}{10}{11}{12}{13} {1}{2}/{14}/{4}-{15}".format(
+		command = "{0} -i {1}{2}/{3}/{4}-{5} -i {1}{2}/{3}/{4}-{6} -i {1}{2}/{3}/{4}-{7} -i {1}{2}/{3}/{4}-{8} {9}{10}{11}{12}{13} {14}".format(
 			ffmpeg_base, TCMConstants.FOOTAGE_PATH, folder, TCMConstants.RAW_FOLDER, stamp, TCMConstants.RIGHT_TEXT,
-			TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.BACK_TEXT, ffmpeg_mid_full,
-			format_timestamp(stamp), ffmpeg_mid2_full, get_event_string(folder, stamp), ffmpeg_end_full, TCMConstants.FULL_FOLDER, TCMConstants.FULL_TEXT)
+			TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.BACK_TEXT, ffmpeg_mid_full.format(**settings),
+			format_timestamp(stamp), ffmpeg_mid2_full, get_event_string(folder, stamp), ffmpeg_end_full.format(**settings), full_output)
 	elif video_type == 1:
-		command = "{0} -i {1}{2}/{3}/{4}-{5} {6} {1}{2}/{7}/{4}-{8}".format(
-			ffmpeg_base, TCMConstants.FOOTAGE_PATH, folder, TCMConstants.FULL_FOLDER, stamp, TCMConstants.FULL_TEXT, ffmpeg_end_fast,
-			TCMConstants.FAST_FOLDER, TCMConstants.FAST_TEXT)
+		command = "{0} {7} -i {1}{2}/{3}/{4}-{5} {6} {8}".format(
+			ffmpeg_base, TCMConstants.FOOTAGE_PATH, folder, TCMConstants.FULL_FOLDER, stamp, TCMConstants.FULL_TEXT, ffmpeg_end_fast.format(**settings),
+			settings["fast_input"], fast_output)
+	elif video_type == 2:
+		command = "{0} -i {1}{2}/{3}/{4}-{5} -i {1}{2}/{3}/{4}-{6} -i {1}{2}/{3}/{4}-{7} -i {1}{2}/{3}/{4}-{8} {9}{10}{11}{12}{13} {14} {15} {16}".format(
+			ffmpeg_base, TCMConstants.FOOTAGE_PATH, folder, TCMConstants.RAW_FOLDER, stamp, TCMConstants.RIGHT_TEXT,
+			TCMConstants.FRONT_TEXT, TCMConstants.LEFT_TEXT, TCMConstants.BACK_TEXT, ffmpeg_mid_full.format(**settings),
+			format_timestamp(stamp), ffmpeg_mid2_full, get_event_string(folder, stamp), ffmpeg_end_both.format(**settings), full_output,
+			ffmpeg_end_both_fast.format(**settings), fast_output)
 	else:
 		logger.error(f"Unrecognized video type {video_type} for {stamp} in {folder}")
 	logger.debug(command)
@@ -186,70 +551,25 @@ def get_ffmpeg_command(folder, stamp, video_type):
 
 def get_event_string(folder, stamp):
 	logger.debug(f"Getting event string: folder {folder}, stamp {stamp}")
-	list = os.listdir(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/")
-	for file in list:
-		if TCMConstants.EVENT_JSON in file and file != "-event.json":
-			if event_matches_stamp(file, stamp):
-				with open(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{file}", "r") as jsonfile:
-					event = json.load(jsonfile)
-					jsonstamp = format_timestamp(event['timestamp'].replace('T', '_').replace(':', '-'), True)
-					try:
-						reason = TCMConstants.EVENT_REASON[event['reason']]
-					except:
-						reason = event['reason']
-					try:
-						camera = TCMConstants.EVENT_CAMERA[event['camera']]
-					except:
-						camera = 'camera ' + event['camera']
-					logger.debug(f"{reason} in {event['city']} at {jsonstamp} on camera {camera}")
-					return f"{reason} in {event['city']} at {jsonstamp} on {camera}"
-	return "No event information available"
-
-def event_matches_stamp(file, stamp):
-	try:
-		file_time = datetime.datetime.fromisoformat(file.rsplit('-',1)[0].split('_')[0] + 'T' + file.rsplit('-',1)[0].split('_')[1].replace('-',':'))
-		stamp_time = datetime.datetime.fromisoformat(stamp.split('_')[0] + 'T' + stamp.split('_')[1].replace('-',':'))
-		max_delta = datetime.timedelta(days=0, seconds=TCMConstants.EVENT_DURATION)
-		if (abs(file_time - stamp_time) <= max_delta):
-			return True
-		else:
-			return False
-	except:
-		return False
+	description = EventIndex.get_description(folder, stamp)
+	if description:
+		return description
+	else:
+		return "No event information available"
 
 def add_to_bad_videos(folder, name):
 	simple_name = name.replace(f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/", '')
-	add_string_to_sorted_file(
-		f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_VIDEOS_FILENAME}",
-		simple_name, f"{simple_name}\n",
-		f"Skipping over bad source file: {name}",
-		logging.DEBUG)
+	if BadFiles.add(folder, TCMConstants.BAD_VIDEOS_FILENAME, simple_name, f"{simple_name}\n"):
+		logger.debug(f"Skipping over bad source file: {name}")
+		Catalog.record_bad_clip(folder, simple_name)
 
 def add_to_bad_sizes(folder, stamp, front, left, right, back):
-	add_string_to_sorted_file(
-		f"{TCMConstants.FOOTAGE_PATH}{folder}/{TCMConstants.RAW_FOLDER}/{TCMConstants.BAD_SIZES_FILENAME}",
-		stamp,
-		f"{stamp}: Front {front}, Left {left}, Right {right}, Back: {back}\n",
-		f"Size issue at {stamp} in {folder}: Front {front}, Left {left}, Right {right}, Back: {back}",
-		logging.WARN)
+	if BadFiles.add(folder, TCMConstants.BAD_SIZES_FILENAME, stamp, f"{stamp}: Front {front}, Left {left}, Right {right}, Back: {back}\n"):
+		logger.warning(f"Size issue at {stamp} in {folder}: Front {front}, Left {left}, Right {right}, Back: {back}")
+		Catalog.record_bad_size(folder, stamp)
 
 ### Other utility functions ###
 
-def add_string_to_sorted_file(name, key, string, log_message, log_level):
-	files = []
-	if os.path.isfile(name):
-		with open(name, "r") as file:
-			files = file.readlines()
-			for line in files:
-				if key in line:
-					return
-	files.append(string)
-	with open(name, "w+") as writer:
-		outlist = sorted(files)
-		logger.log(log_level, log_message)
-		for line in outlist:
-			writer.write(line)
-
 def format_timestamp(stamp, seconds=False):
 	timestamp = datetime.datetime.strptime(stamp, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
 	logger.debug(f"Timestamp: {timestamp}")
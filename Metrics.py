@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# This module keeps counters, gauges and histograms for the services and
+# exports them in the Prometheus text format. If METRICS_PATH is set, each
+# service writes its metrics to "tcm-<service>.prom" there on every loop, for
+# node_exporter's textfile collector. If the service has a port in
+# METRICS_PORTS, the metrics are also served at /metrics on that port. Every
+# sample gets a "service" label with the name of the script.
+
+import os
+import threading
+import http.server
+import logging
+import TCMConstants
+
+METRICS = {
+	'tcm_ffmpeg_wall_seconds' : ('histogram', 'Wall clock time of ffmpeg commands'),
+	'tcm_ffmpeg_cpu_seconds' : ('histogram', 'CPU time of ffmpeg commands'),
+	'tcm_ffmpeg_failures_total' : ('counter', 'ffmpeg commands that failed'),
+	'tcm_merge_queue_jobs' : ('gauge', 'Timestamps waiting for or being merged'),
+	'tcm_merge_oldest_job_seconds' : ('gauge', 'Time the oldest timestamp in the merge queue has been waiting'),
+	'tcm_governor_level' : ('gauge', 'Merge governor level: 0 normal, 1 throttled, 2 paused'),
+	'tcm_governor_reading' : ('gauge', 'Last system reading taken by the merge governor'),
+	'tcm_arrival_to_output_seconds' : ('histogram', 'Time from the camera files arriving in Raw to a merged video'),
+	'tcm_share_wait_seconds' : ('histogram', 'Time clips sat in the share before being moved'),
+	'tcm_moved_files_total' : ('counter', 'Files moved from the share'),
+	'tcm_moved_bytes_total' : ('counter', 'Bytes moved from the share'),
+	'tcm_uploaded_files_total' : ('counter', 'Files uploaded with rclone'),
+	'tcm_uploaded_bytes_total' : ('counter', 'Bytes uploaded with rclone'),
+	'tcm_rclone_failures_total' : ('counter', 'rclone commands that failed'),
+	'tcm_proxy_transcode_seconds' : ('histogram', 'Time taken to transcode upload proxies'),
+	'tcm_proxy_saved_bytes_total' : ('counter', 'Bytes not uploaded thanks to upload proxies'),
+	'tcm_proxy_saved_seconds_total' : ('counter', 'Estimated upload time saved by upload proxies'),
+	'tcm_reclaimed_files_total' : ('counter', 'Files deleted early because the disk was too full'),
+	'tcm_reclaimed_bytes_total' : ('counter', 'Bytes freed by deleting files early because the disk was too full'),
+	'tcm_scan_seconds' : ('histogram', 'Time taken to scan folders for work')
+}
+BUCKETS = [0.01, 0.1, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 21600]
+
+lock = threading.Lock()
+values = {}	# (name, labels) -> value, or [bucket counts, sum, count] for histograms
+
+def get_key(name, labels):
+	return (name, tuple(sorted((labels or {}).items())))
+
+def increment(name, amount=1, labels=None):
+	with lock:
+		key = get_key(name, labels)
+		values[key] = values.get(key, 0) + amount
+
+def set_gauge(name, value, labels=None):
+	with lock:
+		values[get_key(name, labels)] = value
+
+def observe(name, value, labels=None):
+	with lock:
+		key = get_key(name, labels)
+		if key not in values:
+			values[key] = [[0] * len(BUCKETS), 0, 0]
+		buckets, total, count = values[key]
+		for index, bound in enumerate(BUCKETS):
+			if value <= bound:
+				buckets[index] += 1
+		values[key] = [buckets, total + value, count + 1]
+
+def format_labels(labels, extra=()):
+	labels = (('service', TCMConstants.get_basename()),) + labels + extra
+	return ",".join('{0}="{1}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels)
+
+def render():
+	lines = []
+	with lock:
+		items = sorted(values.items(), key=lambda item: (item[0][0], item[0][1]))
+		last_name = None
+		for (name, labels), value in items:
+			metric_type, description = METRICS.get(name, ('untyped', name))
+			if name != last_name:
+				lines.append(f"# HELP {name} {description}")
+				lines.append(f"# TYPE {name} {metric_type}")
+				last_name = name
+			if metric_type == 'histogram':
+				buckets, total, count = value
+				for bound, bucket in zip(BUCKETS, buckets):
+					lines.append(f"{name}_bucket{{{format_labels(labels, (('le', bound),))}}} {bucket}")
+				lines.append(f"{name}_bucket{{{format_labels(labels, (('le', '+Inf'),))}}} {count}")
+				lines.append(f"{name}_sum{{{format_labels(labels)}}} {total}")
+				lines.append(f"{name}_count{{{format_labels(labels)}}} {count}")
+			else:
+				lines.append(f"{name}{{{format_labels(labels)}}} {value}")
+	return "\n".join(lines) + "\n"
+
+def export():
+	if not TCMConstants.METRICS_PATH:
+		return
+	name = f"{TCMConstants.METRICS_PATH}tcm-{TCMConstants.get_basename()}.prom"
+	try:
+		with open(f"{name}.tmp", "w") as file:
+			file.write(render())
+		os.replace(f"{name}.tmp", name)
+	except OSError as error:
+		logging.getLogger(TCMConstants.get_basename()).error(f"Failed to write metrics to {name}: {error}")
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split("?")[0] != "/metrics":
+			self.send_error(404)
+			return
+		body = render().encode("UTF-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logging.getLogger(TCMConstants.get_basename()).debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+def start():
+	logger = logging.getLogger(TCMConstants.get_basename())
+	port = TCMConstants.METRICS_PORTS.get(TCMConstants.get_basename())
+	if not port:
+		return
+	try:
+		server = http.server.ThreadingHTTPServer((TCMConstants.METRICS_ADDRESS, port), MetricsHandler)
+	except OSError as error:
+		logger.error(f"Could not serve metrics on port {port}: {error}")
+		return
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+	logger.info(f"Serving metrics at http://{TCMConstants.METRICS_ADDRESS}:{port}/metrics")
@@ -5,22 +5,35 @@
 #	- video files under "VIDEO_PATHS"
 # that have a name with a timestamp more than "DAYS_TO_KEEP" days old
 # Files and directories who names don't match this format are left alone
+# If the disk gets fuller than "DISK_HIGH_WATERMARK", it also removes the
+# oldest video files in "RETENTION_ORDER" until enough space is free
 
 import os
 import time
+import heapq
 import shutil
 import TCMConstants
 import Stats
+import Catalog
+import Metrics
+import SystemStatus
 import datetime
 import re
 
 VIDEO_PATHS = []
 
-ALL_VIDEO_REGEX = f"{TCMConstants.FILENAME_REGEX[:-5]}|fast|full).mp4"
+ALL_VIDEO_REGEX = f"{TCMConstants.FILENAME_REGEX[:-5]}|fast|full|event-fast|event-full).mp4"
 ALL_VIDEO_PATTERN = re.compile(ALL_VIDEO_REGEX)
 EVENTFILE_REGEX  = '(\d{4}(-\d\d){2}_(\d\d-){3})event.json'
 EVENTFILE_PATTERN = re.compile(EVENTFILE_REGEX)
 
+# Files under VIDEO_PATHS and directories in the share folders are kept in a
+# heap by the time they become old enough to delete. A folder is only listed
+# again when its mtime changes, and then only names that are new to it are
+# parsed. Every RETENTION_RESCAN seconds the index is rebuilt from scratch.
+expiry_heap = []	# (expiry time, folder, name, is directory)
+folder_index = {}	# folder -> (mtime, names in it)
+
 logger = TCMConstants.get_logger()
 
 def main():
@@ -28,32 +41,44 @@ def main():
 		logger.error("Missing some required permissions, exiting")
 		TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
 
-	if TCMConstants.MULTI_CAR:
-		for car in TCMConstants.CAR_LIST:
-			setup_video_paths(f"{car}/")
-	else:
-		setup_video_paths("")
+	for car_path in get_car_paths():
+		setup_video_paths(car_path)
 
+	Metrics.start()
+	last_rescan = 0
 	while True:
+		scan_start = time.time()
+		if scan_start - last_rescan >= TCMConstants.RETENTION_RESCAN:
+			logger.debug("Rebuilding the retention index")
+			last_rescan = scan_start
+			expiry_heap.clear()
+			folder_index.clear()
 		for share in TCMConstants.SHARE_PATHS:
 			for folder in TCMConstants.FOOTAGE_FOLDERS:
-				for directory in next(os.walk(f"{share}{folder}"))[1]:
-					if os.listdir(f"{share}{folder}/{directory}"):
-						logger.debug(f"Directory {share}{folder}/{directory} not empty, skipping")
-					else:
-						remove_empty_old_directory(f"{share}{folder}/", directory)
-
+				update_folder(f"{share}{folder}", True)
 		for path in VIDEO_PATHS:
-			for file in os.listdir(path):
-				remove_old_file(path, file)
+			update_folder(path, False)
+		remove_expired()
+		relieve_disk_pressure()
+		Metrics.observe('tcm_scan_seconds', time.time() - scan_start, {'scan' : 'full'})
 
 		if datetime.datetime.now().minute in TCMConstants.STATS_FREQUENCY:
-			Stats.generate_stats_image()
+			try:
+				Stats.generate_stats_image()
+			except Exception:
+				logger.exception("Failed to generate the stats image")
 
+		Metrics.export()
 		time.sleep(TCMConstants.SLEEP_DURATION)
 
 ### Startup functions ###
 
+def get_car_paths():
+	if TCMConstants.MULTI_CAR:
+		return [f"{car}/" for car in TCMConstants.CAR_LIST]
+	else:
+		return [""]
+
 def setup_video_paths(car_path):
 	for folder in TCMConstants.FOOTAGE_FOLDERS:
 		VIDEO_PATHS.append(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.RAW_FOLDER}")
@@ -71,26 +96,155 @@ def have_required_permissions():
 
 ### Loop functions ###
 
-def remove_empty_old_directory(path, name):
-	if is_old_enough(name):
-		logger.info(f"Removing empty directory: {path}{name}")
-		try:
-			os.rmdir(f"{path}{name}")
-		except:
-			logger.error(f"Error removing directory: {path}{name}")
+def update_folder(path, directories):
+	# Adds the files (or directories) that are new in path to the heap
+	try:
+		mtime = os.stat(path).st_mtime_ns
+	except OSError as error:
+		logger.error(f"Error reading folder {path}: {error}")
+		return
+	previous_mtime, names = folder_index.get(path, (None, set()))
+	if mtime == previous_mtime:
+		return
+	try:
+		with os.scandir(path) as entries:
+			current = {entry.name for entry in entries if entry.is_dir(follow_symlinks=False) == directories}
+	except OSError as error:
+		logger.error(f"Error listing folder {path}: {error}")
+		return
+	for name in current - names:
+		expiry = get_expiry(name if directories else extract_stamp(name))
+		if expiry is not None:
+			heapq.heappush(expiry_heap, (expiry, path, name, directories))
+	folder_index[path] = (mtime, current)
+
+def remove_expired():
+	now = datetime.datetime.now()
+	removed = {}
+	retries = []
+	while expiry_heap and expiry_heap[0][0] <= now:
+		expiry, path, name, directory = heapq.heappop(expiry_heap)
+		if directory:
+			if not remove_empty_old_directory(f"{path}/", name):
+				retries.append((path, name, directory))
+		elif remove_old_file(path, name):
+			removed.setdefault(path, []).append(name)
+		elif os.path.lexists(f"{path}/{name}"):
+			retries.append((path, name, directory))
+	# Directories that are not empty yet and files that could not be removed
+	# are tried again on the next loop, like before the index existed
+	retry = now + datetime.timedelta(seconds=TCMConstants.SLEEP_DURATION)
+	for path, name, directory in retries:
+		heapq.heappush(expiry_heap, (retry, path, name, directory))
+	deletions = []
+	for path, names in removed.items():
+		logger.info(f"Removed {len(names)} old files from {path}")
+		deletions += [deletion for deletion in (get_deletion(path, name) for name in names) if deletion]
+	Catalog.record_deletions(deletions)
+
+def relieve_disk_pressure():
+	if not TCMConstants.DISK_HIGH_WATERMARK:
+		return
+	disk = SystemStatus.get_disk_usage(TCMConstants.FOOTAGE_PATH)
+	if disk is None or disk.used_percentage <= TCMConstants.DISK_HIGH_WATERMARK:
+		return
+	to_free = disk.used - (disk.used + disk.available) * TCMConstants.DISK_LOW_WATERMARK // 100
+	logger.warning(f"Disk is {disk.used_percentage}% full, removing videos to free {TCMConstants.convert_file_size(to_free).strip()}")
+	freed = 0
+	deletions = []
+	for folder, kind in TCMConstants.RETENTION_ORDER:
+		if freed >= to_free:
+			break
+		files = 0
+		size = 0
+		for path, name in get_pressure_candidates(folder, kind):
+			if freed + size >= to_free:
+				break
+			try:
+				file_size = os.stat(f"{path}/{name}").st_size
+			except OSError:
+				continue
+			if remove_old_file(path, name):
+				files += 1
+				size += file_size
+				deletions.append(get_deletion(path, name))
+				# Later classes in RETENTION_ORDER look at what is left
+				folder_index.get(path, (None, set()))[1].discard(name)
+		if files:
+			logger.info(f"Removed {files} files from {kind} in {folder} to free {TCMConstants.convert_file_size(size).strip()}")
+			Metrics.increment('tcm_reclaimed_files_total', files, {'folder' : folder, 'kind' : kind})
+			Metrics.increment('tcm_reclaimed_bytes_total', size, {'folder' : folder, 'kind' : kind})
+		freed += size
+	Catalog.record_deletions([deletion for deletion in deletions if deletion])
+	if freed >= to_free:
+		logger.info(f"Freed {TCMConstants.convert_file_size(freed).strip()} of disk space")
 	else:
-		logger.debug(f"Directory {path}{name} is not ready for deletion, skipping")
+		logger.error(f"Freed only {TCMConstants.convert_file_size(freed).strip()} of disk space, nothing else in RETENTION_ORDER can be removed")
+
+def get_pressure_candidates(folder, kind):
+	# Returns (path, name) of the videos of one class, oldest first
+	candidates = []
+	for car_path in get_car_paths():
+		path = f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{kind}"
+		merged = folder_index.get(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.FULL_FOLDER}", (None, set()))[1]
+		raw = get_stamps(folder_index.get(f"{TCMConstants.FOOTAGE_PATH}{car_path}{folder}/{TCMConstants.RAW_FOLDER}", (None, set()))[1])
+		for name in folder_index.get(path, (None, set()))[1]:
+			match = ALL_VIDEO_PATTERN.match(name)
+			if not match:
+				continue
+			stamp = match.group(1)[:-1]
+			if kind == TCMConstants.RAW_FOLDER and f"{stamp}-{TCMConstants.FULL_TEXT}" not in merged:
+				continue
+			# MergeTeslaCam would merge the stamp again if its outputs went first
+			if kind != TCMConstants.RAW_FOLDER and stamp in raw:
+				continue
+			candidates.append((stamp, path, name))
+	return [(path, name) for stamp, path, name in sorted(candidates)]
+
+def get_stamps(names):
+	stamps = set()
+	for name in names:
+		match = ALL_VIDEO_PATTERN.match(name)
+		if match:
+			stamps.add(match.group(1)[:-1])
+	return stamps
+
+def remove_empty_old_directory(path, name):
+	# Returns False if the directory is still there
+	if not os.path.isdir(f"{path}{name}"):
+		return True
+	if os.listdir(f"{path}{name}"):
+		logger.debug(f"Directory {path}{name} not empty, skipping")
+		return False
+	logger.info(f"Removing empty directory: {path}{name}")
+	try:
+		os.rmdir(f"{path}{name}")
+		return True
+	except:
+		logger.error(f"Error removing directory: {path}{name}")
+		return False
 
 def remove_old_file(path, file):
-	if is_old_enough(extract_stamp(file)):
-		logger.info(f"Removing old file: {path}/{file}")
-		try:
-			os.remove(f"{path}/{file}")
-			pass
-		except:
-			logger.error(f"Error removing file: {path}/{file}")
-	else:
-		logger.debug(f"File {path}/{file} is not ready for deletion, skipping")
+	logger.debug(f"Removing old file: {path}/{file}")
+	try:
+		os.remove(f"{path}/{file}")
+		return True
+	except FileNotFoundError:
+		logger.debug(f"File {path}/{file} already gone")
+	except:
+		logger.error(f"Error removing file: {path}/{file}")
+	return False
+
+def get_deletion(path, file):
+	# Returns the catalog entry for a deleted file as (sub_path, kind, stamp, camera)
+	sub_path, kind = path[len(TCMConstants.FOOTAGE_PATH):].rsplit("/", 1)
+	if file.endswith((TCMConstants.EVENT_FULL_TEXT, TCMConstants.EVENT_FAST_TEXT)):
+		return None
+	try:
+		stamp, camera = file.rsplit("-", 1)
+	except ValueError:
+		return None
+	return sub_path, kind, stamp, camera
 
 def extract_stamp(file):
 	match_video = ALL_VIDEO_PATTERN.match(file)
@@ -105,17 +259,14 @@ def extract_stamp(file):
 		logger.debug(f"No valid stamp found for file: {file}")
 		return None
 
-def is_old_enough(stamp_in_name):
+def get_expiry(stamp_in_name):
+	# Returns when something with this stamp is more than DAYS_TO_KEEP days old
 	try:
 		stamp = datetime.datetime.strptime(stamp_in_name, TCMConstants.FILENAME_TIMESTAMP_FORMAT)
-		age = datetime.datetime.now() - stamp
-		if age.days > TCMConstants.DAYS_TO_KEEP:
-			return True
-		else:
-			return False
+		return stamp + datetime.timedelta(days=TCMConstants.DAYS_TO_KEEP + 1)
 	except:
 		logger.debug(f"Unrecognized name: {stamp_in_name}, skipping")
-		return False
+		return None
 
 if __name__ == '__main__':
 	main()
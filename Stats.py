@@ -1,103 +1,186 @@
 #!/usr/bin/env python3
 
-# This script generates an image with statistics if STATS_FILENAME is set
+# This script generates an image with statistics if STATS_FILENAME is set.
+# With STATS_RENDERER set to 'pillow' the image is drawn by StatsImage,
+# otherwise stats-template.html is filled in and captured with cutycapt.
 
 import os
 import time
 import TCMConstants
+import Catalog
+import SystemStatus
 import subprocess
 import datetime
 import re
 import logging
 
+try:
+	import StatsImage
+except ImportError:
+	StatsImage = None
+
+TEMPLATE_FIELDS = ["DEVICE", "SIZE", "USED", "AVAILABLE", "USED_PERCENTAGE", "MOUNT_POINT",
+	"DIRECTORY_TABLE_ROWS", "SERVICE_TABLE_ROWS", "CATALOG_TABLE_ROWS", "TIMESTAMP", "DISK_COLOR"]
+
+template = None		# stats-template.html split at the TEMPLATE_FIELDS
+directory_cache = {}	# path -> (mtime, settled, files, bytes, subdirectories)
+
 def generate_stats_image():
 	logger = logging.getLogger(TCMConstants.get_basename())
 	if TCMConstants.STATS_FILENAME:
-		logger.debug(f"Generating stats in {TCMConstants.STATS_FILENAME}")
+		logger.debug(f"Generating stats in {TCMConstants.STATS_IMAGE}")
 		logger.debug(f"Footage root location: {TCMConstants.FOOTAGE_PATH}")
-		with open(f"{TCMConstants.PROJECT_PATH}/TeslaCamMerge/stats-template.html", "r") as template:
-			html = template.read()
-			logger.debug(f"Read template:\n{html}")
-			device, size, used, available, used_percentage, mount_point = get_disk_usage_details(TCMConstants.FOOTAGE_PATH)
-			directory_table_rows = get_directory_table_rows(TCMConstants.FOOTAGE_PATH)
-			service_table_rows = get_service_table_rows()
-			timestamp = datetime.datetime.now().strftime(TCMConstants.STATS_TIMESTAMP_FORMAT)
-			replacements = {
-				"DEVICE" : device,
-				"SIZE" : size,
-				"USED" : used,
-				"AVAILABLE" : available,
-				"USED_PERCENTAGE" : used_percentage,
-				"MOUNT_POINT" : mount_point,
-				"DIRECTORY_TABLE_ROWS" : directory_table_rows,
-				"SERVICE_TABLE_ROWS" : service_table_rows,
-				"TIMESTAMP" : timestamp,
-				"DISK_COLOR" : get_disk_color(used_percentage)
-			}
-			output = ""
-			for line in html.splitlines():
-				output += do_replacements(line, replacements)
-			logger.debug(f"HTML output:\n{output}")
-			with open(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}", "w+") as file:
-				file.write(output)
-		command = f'{TCMConstants.XVFB_RUN_PATH} --server-args="-screen 0, 1280x1200x24" {TCMConstants.CUTYCAPT_PATH} --url=file://{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME} --out={TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_IMAGE}'
-		logger.debug(f"Command: {command}")
-		completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
-			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		if completed.returncode == 0:
-			logger.info("Updated stats image")
-			try:
-				os.remove(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
-			except:
-				logger.error(f"Error removing: {TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
+		disk = SystemStatus.get_disk_usage(TCMConstants.FOOTAGE_PATH)
+		directories = get_directory_rows(TCMConstants.FOOTAGE_PATH)
+		services = get_service_rows()
+		merges = Catalog.get_summary()
+		timestamp = datetime.datetime.now().strftime(TCMConstants.STATS_TIMESTAMP_FORMAT)
+		if TCMConstants.STATS_RENDERER == 'pillow' and StatsImage is not None:
+			render_image(disk, directories, services, merges, timestamp)
 		else:
-			logger.error(f"Error running cutycapt command {command}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+			if TCMConstants.STATS_RENDERER == 'pillow':
+				logger.warning("Pillow is not installed, using cutycapt for the stats image")
+			render_html(disk, directories, services, merges, timestamp)
+
+def render_image(disk, directories, services, merges, timestamp):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	font_sizes = [16, 14, 12]
+	directory_rows = [[(f"{'  ' * level}{name}", font_sizes[level], "left", None),
+		(f"{num_files:,d}", font_sizes[level], "right", None),
+		(TCMConstants.convert_file_size(total_size).strip(), font_sizes[level], "right", None)]
+		for level, name, num_files, total_size in directories]
+	service_rows = [[(name, 16, "center", (0, 255, 0) if running else (255, 0, 0))]
+		for name, running in services]
+	merge_rows = [[(f"{car}/{folder}" if car else folder, 16, "left", None)] +
+		[(f"{count:,d}", 16, "right", None) for count in [merged, waiting, bad]]
+		for car, folder, merged, waiting, bad in merges]
+	device, size, used, available, used_percentage, mount_point = get_disk_cells(disk)
+	disk_rows = [[(device, 16, "left", None), (size, 16, "right", None),
+		(used, 16, "right", None), (available, 16, "right", None),
+		(used_percentage, 16, "right", get_disk_color(disk and disk.used_percentage)),
+		(mount_point, 16, "left", None)]]
+	image = f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_IMAGE}"
+	try:
+		StatsImage.draw_stats(f"{image}.tmp",
+			[("Video Files", ["Folder", "#", "Size"], directory_rows)],
+			[("Services", [], service_rows), ("Merges", ["Folder", "Merged", "Waiting", "Bad"], merge_rows)],
+			[("Disk Space Details", ["Filesystem", "Size", "Used", "Avail", "Use%", "Mount"], disk_rows)],
+			f"Generated at {timestamp}")
+		os.replace(f"{image}.tmp", image)
+		logger.info("Updated stats image")
+	except Exception as error:
+		# A broken or too old Pillow must not stop the caller's loop
+		logger.error(f"Error drawing stats image {image}, skipping it: {error}")
+		try:
+			os.remove(f"{image}.tmp")
+		except OSError:
+			pass
+
+def render_html(disk, directories, services, merges, timestamp):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	device, size, used, available, used_percentage, mount_point = get_disk_cells(disk)
+	replacements = {
+		"DEVICE" : device,
+		"SIZE" : size,
+		"USED" : used,
+		"AVAILABLE" : available,
+		"USED_PERCENTAGE" : used_percentage,
+		"MOUNT_POINT" : mount_point,
+		"DIRECTORY_TABLE_ROWS" : get_directory_table_rows(directories),
+		"SERVICE_TABLE_ROWS" : get_service_table_rows(services),
+		"CATALOG_TABLE_ROWS" : get_catalog_table_rows(merges),
+		"TIMESTAMP" : timestamp,
+		"DISK_COLOR" : "rgb{0};".format(get_disk_color(disk and disk.used_percentage))
+	}
+	output = do_replacements(get_template(), replacements)
+	logger.debug(f"HTML output:\n{output}")
+	with open(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}", "w+") as file:
+		file.write(output)
+	command = f'{TCMConstants.XVFB_RUN_PATH} --server-args="-screen 0, 1280x1200x24" {TCMConstants.CUTYCAPT_PATH} --url=file://{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME} --out={TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_IMAGE}'
+	logger.debug(f"Command: {command}")
+	completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if completed.returncode == 0:
+		logger.info("Updated stats image")
+		try:
+			os.remove(f"{TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
+		except:
+			logger.error(f"Error removing: {TCMConstants.FOOTAGE_PATH}/{TCMConstants.STATS_FILENAME}")
+	else:
+		logger.error(f"Error running cutycapt command {command}, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+
+def get_disk_cells(disk):
+	# Formats a SystemStatus.DiskUsage for the disk space table
+	if disk is None:
+		return "", "", "", "", "", ""
+	return (disk.device or "", TCMConstants.convert_file_size(disk.size).strip(),
+		TCMConstants.convert_file_size(disk.used).strip(), TCMConstants.convert_file_size(disk.available).strip(),
+		f"{disk.used_percentage}%", disk.mount_point or "")
 
 def get_disk_color(used_percentage):
-	used = int(used_percentage[:-1])
-	if used < 80:
-		return "rgb(0, 255, 0);"
-	elif used < 90:
-		return "rgb(255, 255, 0);"
+	if used_percentage is None:
+		return (255, 255, 255)
+	elif used_percentage < 80:
+		return (0, 255, 0)
+	elif used_percentage < 90:
+		return (255, 255, 0)
 	else:
-		return "rgb(255, 0, 0);"
+		return (255, 0, 0)
 
-def do_replacements(line, replacements):
-        substrs = sorted(replacements, key=len, reverse=True)
-        regexp = re.compile('|'.join(map(re.escape, substrs)))
-        return regexp.sub(lambda match: replacements[match.group(0)], line)
+def get_template():
+	# Reads the template once and splits it into text and placeholders
+	global template
+	if template is None:
+		with open(f"{TCMConstants.PROJECT_PATH}/TeslaCamMerge/stats-template.html", "r") as file:
+			html = file.read()
+		fields = sorted(TEMPLATE_FIELDS, key=len, reverse=True)
+		template = re.split(f"({'|'.join(map(re.escape, fields))})", html)
+	return template
 
-def get_directory_table_rows(path):
-	output = ""
-	for item in os.listdir(path):
-		if item == TCMConstants.STATS_FILENAME or item == TCMConstants.STATS_IMAGE:
-			continue
-		num_files, total_size = get_folder_details(path, item)
-		output += f"<tr><td>{item}</td><td class='number'>{num_files:,d}</td><td class='number'>{total_size}</td></tr>"
+def do_replacements(parts, replacements):
+	# Placeholders are at the odd positions of the split template
+	return "".join(str(replacements[part]) if index % 2 else part for index, part in enumerate(parts))
+
+def get_directory_rows(path):
+	# Returns rows of (indent level, name, files, bytes)
+	rows = []
+	files, size, children = get_directory_tree(path)
+	for item, (num_files, total_size, subfolders) in sorted(children.items()):
+		rows.append((0, item, num_files, total_size))
 		if TCMConstants.MULTI_CAR and item in TCMConstants.CAR_LIST and num_files > 0:
 			for folder in TCMConstants.FOOTAGE_FOLDERS:
-				sub_files, sub_size = get_folder_details(f"{path}/{item}", folder)
-				output += f"<tr><td class='small'>&nbsp;&nbsp;{folder}</td><td class='smallnumber'>{sub_files:,d}</td><td class='smallnumber'>{sub_size}</td></tr>"
+				sub_files, sub_size, sub_folders = subfolders.get(folder, (0, 0, {}))
+				rows.append((1, folder, sub_files, sub_size))
 				if sub_files > 0:
-					output += get_subdirectory_table_rows(f"{path}/{item}/{folder}", "&nbsp;&nbsp;&nbsp;&nbsp;", "smaller")
+					rows += get_subdirectory_rows(sub_folders, 2)
 		else:
 			if item in TCMConstants.FOOTAGE_FOLDERS and num_files > 0:
-				output += get_subdirectory_table_rows(f"{path}/{item}", "&nbsp;&nbsp;", "small")
-	return output
+				rows += get_subdirectory_rows(subfolders, 1)
+	return rows
+
+def get_subdirectory_rows(subfolders, level):
+	rows = []
+	for folder in [TCMConstants.RAW_FOLDER, TCMConstants.FULL_FOLDER, TCMConstants.FAST_FOLDER]:
+		num_files, total_size, unused = subfolders.get(folder, (0, 0, {}))
+		rows.append((level, folder, num_files, total_size))
+	return rows
 
-def get_subdirectory_table_rows(path, indent, font_class):
+def get_directory_table_rows(directories):
 	output = ""
-	raw_files, raw_size = get_folder_details(path, TCMConstants.RAW_FOLDER)
-	output += f"<tr><td class='{font_class}'>{indent}{TCMConstants.RAW_FOLDER}</td><td class='{font_class}number'>{raw_files:,d}</td><td class='{font_class}number'>{raw_size}</td></tr>"
-	full_files, full_size = get_folder_details(path, TCMConstants.FULL_FOLDER)
-	output += f"<tr><td class='{font_class}'>{indent}{TCMConstants.FULL_FOLDER}</td><td class='{font_class}number'>{full_files:,d}</td><td class='{font_class}number'>{full_size}</td></tr>"
-	fast_files, fast_size = get_folder_details(path, TCMConstants.FAST_FOLDER)
-	output += f"<tr><td class='{font_class}'>{indent}{TCMConstants.FAST_FOLDER}</td><td class='{font_class}number'>{fast_files:,d}</td><td class='{font_class}number'>{fast_size}</td></tr>"
+	for level, name, num_files, total_size in directories:
+		indent = "&nbsp;&nbsp;" * level
+		font_class = ["", "small", "smaller"][level]
+		number_class = f"{font_class}number"
+		if font_class:
+			output += f"<tr><td class='{font_class}'>{indent}{name}</td>"
+		else:
+			output += f"<tr><td>{name}</td>"
+		output += f"<td class='{number_class}'>{num_files:,d}</td><td class='{number_class}'>{TCMConstants.convert_file_size(total_size)}</td></tr>"
 	return output
 
-def get_service_table_rows():
-	command = f"{TCMConstants.SYSTEMCTL_PATH} show -p Id -p Name -p SubState --value tcm-*"
-	output = get_service_details(command)
+def get_service_rows():
+	# Returns SystemStatus.ServiceState rows of (service name, running)
+	rows = SystemStatus.get_services("tcm-")
 	creds = ""
 	try:
 		import DownloadTC
@@ -105,53 +188,65 @@ def get_service_table_rows():
 	except:
 		logging.getLogger(TCMConstants.get_basename()).debug("No TCM2ndHome connected")
 	if creds:
-		command = f"{TCMConstants.SYSTEMCTL_PATH} show -p Id -p Name -p SubState --value tcm2-* -H {creds}"
-		output += get_service_details(command)
+		rows += SystemStatus.get_services_from_systemctl("tcm2-*", creds)
+	return rows
+
+def get_service_table_rows(services):
+	output = ""
+	for name, running in services:
+		service_class = "servicerunning" if running else "servicedead"
+		output += f"<tr><td class='{service_class}'>{name}</td></tr>"
 	return output
 
-def get_service_details(command):
+def get_catalog_table_rows(merges):
 	output = ""
-	completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
-		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	if completed.stderr or completed.returncode != 0:
-		logging.getLogger(TCMConstants.get_basename()).error(
-			f"Error running systemctl command, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
-	else:
-		lines = completed.stdout.splitlines()
-		i = 0
-		while i < len(lines):
-			if i % 3 == 0:
-				name = lines[i].decode("UTF-8").split(".")[0]
-				service_class = ""
-				if lines[i+1].decode("UTF-8") == "running":
-					service_class = "servicerunning"
-				else:
-					service_class = "servicedead"
-				output += f"<tr><td class='{service_class}'>{name}</td></tr>"
-			i += 1
+	for car, folder, merged, waiting, bad in merges:
+		name = f"{car}/{folder}" if car else folder
+		output += f"<tr><td>{name}</td><td class='number'>{merged:,d}</td><td class='number'>{waiting:,d}</td><td class='number'>{bad:,d}</td></tr>"
 	return output
 
-def get_folder_details(path, file):
-	total_size = 0
-	num_files = 0
-	for dirpath, dirnames, filenames in os.walk(f"{path}/{file}"):
-		for f in filenames:
-			fp = os.path.join(dirpath, f)
-			# Skip symbolic links
-			if not os.path.islink(fp):
-				total_size += os.path.getsize(fp)
-				num_files += 1
-	return num_files, TCMConstants.convert_file_size(total_size)
-
-def get_disk_usage_details(footage_path):
-	logger = logging.getLogger(TCMConstants.get_basename())
-	command = f"{TCMConstants.DF_PATH} -h {footage_path}"
-	completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
-		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	if completed.stderr or completed.returncode != 0:
-		logger.error(f"Error running df command, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
-		return None, None, None, None, None, None
-	else:
-		logger.debug("Disk space raw result:\n{0}".format(completed.stdout.decode("UTF-8")))
-		line = completed.stdout.decode("UTF-8").splitlines()[1]
-		return re.split("\s+", line)
+def get_directory_tree(path, scan_time=None):
+	# Returns (files, bytes, {subdirectory: tree}) for the directory and
+	# everything below it, skipping symbolic links. The files directly in a
+	# directory are only listed again when its mtime changes, or when one of
+	# them was still being written the last time it was listed.
+	if scan_time is None:
+		scan_time = time.time()
+	try:
+		mtime = os.stat(path).st_mtime_ns
+	except OSError:
+		directory_cache.pop(path, None)
+		return 0, 0, {}
+	cached = directory_cache.get(path)
+	if cached is None or cached[0] != mtime or not cached[1]:
+		num_files = 0
+		total_size = 0
+		newest = 0
+		subdirectories = []
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					try:
+						if entry.is_symlink():
+							continue
+						if entry.is_dir():
+							subdirectories.append(entry.name)
+						else:
+							info = entry.stat(follow_symlinks=False)
+							num_files += 1
+							total_size += info.st_size
+							newest = max(newest, info.st_mtime)
+					except OSError:
+						continue
+		except OSError as error:
+			logging.getLogger(TCMConstants.get_basename()).warning(f"Could not list {path}: {error}")
+		settled = newest < scan_time - TCMConstants.WRITE_QUIESCENCE
+		cached = (mtime, settled, num_files, total_size, subdirectories)
+		directory_cache[path] = cached
+	mtime, settled, num_files, total_size, subdirectories = cached
+	children = {}
+	for name in subdirectories:
+		children[name] = get_directory_tree(f"{path}/{name}", scan_time)
+		num_files += children[name][0]
+		total_size += children[name][1]
+	return num_files, total_size, children
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# This module draws the stats image with Pillow, without starting a browser.
+# Stats passes it the same tables that go into stats-template.html, and it
+# lays them out the same way: video files on the left, services and merges
+# on the right, disk space below. Sizes are those of the template at the
+# zoom factor that cutycapt uses. It needs Pillow 5.1 or later, which is
+# installed with: sudo apt install python3-pil
+
+from PIL import Image, ImageDraw, ImageFont
+
+SCALE = 1.5
+WIDTH = 1280
+MAX_HEIGHT = 4000
+MARGIN = int(8 * SCALE)
+PADDING = int(12 * SCALE)
+SPACER = int(20 * SCALE)
+RIGHT_COLUMN = int(WIDTH * 0.55)
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+
+fonts = {}	# (size, bold) -> font
+
+def get_font(size, bold=False):
+	if (size, bold) not in fonts:
+		try:
+			fonts[(size, bold)] = ImageFont.truetype(
+				"DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf", int(size * SCALE))
+		except OSError:
+			fonts[(size, bold)] = ImageFont.load_default()
+	return fonts[(size, bold)]
+
+def get_text_size(text, font):
+	# getbbox is only in Pillow 8.0 and later (9.2 for the default font),
+	# and getsize was removed in 10.0, so use whichever the font has
+	if hasattr(font, "getbbox"):
+		box = font.getbbox(text)
+		return box[2], box[3]
+	return font.getsize(text)
+
+def get_text_width(text, font):
+	return get_text_size(text, font)[0] if text else 0
+
+def get_line_height(font):
+	return get_text_size("Ag", font)[1]
+
+def draw_heading(draw, x, y, text, size):
+	font = get_font(size, True)
+	draw.text((x, y), text, font=font, fill=BLACK)
+	return y + get_line_height(font) + int(size * SCALE * 0.8)
+
+def draw_table(draw, x, y, headers, rows):
+	# Each row is a list of cells, each cell a tuple of (text, font size,
+	# alignment, background color or None). Returns the y below the table.
+	header_font = get_font(16, True)
+	lines = []
+	if headers:
+		lines.append([(header, header_font, "center", None) for header in headers])
+	for row in rows:
+		lines.append([(text, get_font(size), align, background) for text, size, align, background in row])
+	if not lines:
+		return y
+	columns = max(len(line) for line in lines)
+	widths = [0] * columns
+	for line in lines:
+		for index, (text, font, align, background) in enumerate(line):
+			widths[index] = max(widths[index], get_text_width(text, font) + 2 * PADDING)
+	for line in lines:
+		height = max(get_line_height(font) for text, font, align, background in line) + 2 * PADDING
+		left = x
+		for index, (text, font, align, background) in enumerate(line):
+			right = left + widths[index]
+			draw.rectangle([left, y, right, y + height], fill=background or WHITE, outline=BLACK)
+			if align == "right":
+				text_x = right - PADDING - get_text_width(text, font)
+			elif align == "center":
+				text_x = left + (widths[index] - get_text_width(text, font)) // 2
+			else:
+				text_x = left + PADDING
+			draw.text((text_x, y + (height - get_line_height(font)) // 2), text, font=font, fill=BLACK)
+			left = right
+		y += height
+	return y
+
+def draw_stats(image_path, left, right, bottom, footer):
+	# left, right and bottom are lists of (title, headers, rows) tables
+	image = Image.new("RGB", (WIDTH, MAX_HEIGHT), WHITE)
+	draw = ImageDraw.Draw(image)
+	y = draw_heading(draw, MARGIN, MARGIN, "Footage Details", 32)
+	columns_y = []
+	for x, tables in [(MARGIN, left), (RIGHT_COLUMN, right)]:
+		column_y = y
+		for title, headers, rows in tables:
+			column_y = draw_heading(draw, x, column_y, title, 24)
+			column_y = draw_table(draw, x, column_y, headers, rows) + PADDING
+		columns_y.append(column_y)
+	y = max(columns_y) + SPACER
+	for title, headers, rows in bottom:
+		y = draw_heading(draw, MARGIN, y, title, 24)
+		y = draw_table(draw, MARGIN, y, headers, rows) + SPACER
+	font = get_font(12)
+	draw.text((MARGIN, y), footer, font=font, fill=BLACK)
+	y += get_line_height(font) + MARGIN
+	image.crop((0, 0, WIDTH, min(y, MAX_HEIGHT))).save(image_path, "PNG")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# This module collects the state of the system for Stats and any other
+# consumer without starting processes. Disk usage comes from os.statvfs and
+# /proc/self/mounts, and a service is running if its systemd control group
+# has processes in it. Values are returned as numbers and booleans, and it
+# is up to the caller to format them. If the control groups cannot be
+# found, service state falls back to systemctl. Load, pressure and
+# temperature readings are None where the kernel does not provide them.
+
+import os
+import glob
+import collections
+import subprocess
+import logging
+import TCMConstants
+
+UNIT_PATHS = ['/etc/systemd/system', '/lib/systemd/system', '/usr/lib/systemd/system']
+CGROUP_PATHS = ['/sys/fs/cgroup/system.slice', '/sys/fs/cgroup/unified/system.slice',
+	'/sys/fs/cgroup/systemd/system.slice']
+PRESSURE_PATH = '/proc/pressure/'
+THERMAL_PATHS = '/sys/class/thermal/thermal_zone*/temp'
+
+# Sizes are in bytes, used_percentage is rounded up like df does
+DiskUsage = collections.namedtuple('DiskUsage',
+	['device', 'size', 'used', 'available', 'used_percentage', 'mount_point'])
+ServiceState = collections.namedtuple('ServiceState', ['name', 'running'])
+
+def get_disk_usage(path):
+	try:
+		info = os.statvfs(path)
+	except OSError as error:
+		logging.getLogger(TCMConstants.get_basename()).error(f"Could not get disk usage of {path}: {error}")
+		return None
+	size = info.f_blocks * info.f_frsize
+	used = (info.f_blocks - info.f_bfree) * info.f_frsize
+	available = info.f_bavail * info.f_frsize
+	used_percentage = -(-used * 100 // (used + available)) if used + available else 0
+	device, mount_point = get_mount(path)
+	return DiskUsage(device, size, used, available, used_percentage, mount_point)
+
+def get_mount(path):
+	# Returns the device and mount point of the file system holding path
+	path = os.path.realpath(path)
+	device, mount_point = None, None
+	try:
+		with open('/proc/self/mounts', 'r') as mounts:
+			for line in mounts:
+				fields = line.split()
+				if len(fields) < 2:
+					continue
+				point = fields[1].replace('\\040', ' ')
+				if (path == point or path.startswith(point.rstrip('/') + '/')) and (mount_point is None or len(point) >= len(mount_point)):
+					device, mount_point = fields[0], point
+	except OSError as error:
+		logging.getLogger(TCMConstants.get_basename()).debug(f"Could not read mounts: {error}")
+	return device, mount_point
+
+def get_load_per_cpu():
+	# One minute load average divided by the number of CPUs
+	try:
+		return os.getloadavg()[0] / (os.cpu_count() or 1)
+	except OSError:
+		return None
+
+def get_pressure(resource):
+	# Percentage of the last ten seconds in which some tasks were stalled on
+	# the resource ('cpu', 'io' or 'memory')
+	try:
+		with open(f"{PRESSURE_PATH}{resource}", 'r') as pressure:
+			for line in pressure:
+				fields = line.split()
+				if fields and fields[0] == 'some':
+					return float(dict(field.split('=', 1) for field in fields[1:])['avg10'])
+	except (OSError, ValueError, KeyError):
+		pass
+	return None
+
+def get_temperature():
+	# Temperature of the hottest thermal zone in degrees Celsius
+	temperatures = []
+	for path in glob.glob(THERMAL_PATHS):
+		try:
+			with open(path, 'r') as zone:
+				temperatures.append(int(zone.read().strip()) / 1000)
+		except (OSError, ValueError):
+			continue
+	return max(temperatures) if temperatures else None
+
+def get_services(prefix):
+	# Returns the state of the installed services whose names start with prefix
+	cgroup_path = next((path for path in CGROUP_PATHS if os.path.isdir(path)), None)
+	if cgroup_path is None:
+		return get_services_from_systemctl(f"{prefix}*")
+	names = set()
+	for unit_path in UNIT_PATHS:
+		try:
+			names.update(name[:-len('.service')] for name in os.listdir(unit_path)
+				if name.startswith(prefix) and name.endswith('.service'))
+		except OSError:
+			continue
+	return [ServiceState(name, is_running(f"{cgroup_path}/{name}.service")) for name in sorted(names)]
+
+def is_running(cgroup):
+	try:
+		with open(f"{cgroup}/cgroup.procs", 'r') as procs:
+			return bool(procs.read().strip())
+	except OSError:
+		return False
+
+def get_services_from_systemctl(pattern, host=None):
+	logger = logging.getLogger(TCMConstants.get_basename())
+	command = f"{TCMConstants.SYSTEMCTL_PATH} show -p Id -p SubState --value {pattern}"
+	if host:
+		command += f" -H {host}"
+	completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if completed.stderr or completed.returncode != 0:
+		logger.error(f"Error running systemctl command, returncode: {completed.returncode}, stdout: {completed.stdout}, stderr: {completed.stderr}")
+		return []
+	services = []
+	lines = [line.decode("UTF-8") for line in completed.stdout.splitlines() if line.strip()]
+	for index in range(0, len(lines) - 1, 2):
+		services.append(ServiceState(lines[index].split(".")[0], lines[index + 1] == "running"))
+	return services
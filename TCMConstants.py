@@ -2,9 +2,11 @@ import logging
 import logging.handlers
 import os
 import subprocess
+import tempfile
 import re
 import sys
 import signal
+import time
 
 # Location where the TeslaCamMerge directory is present. Must NOT include trailing /.
 PROJECT_PATH = '/home/pavan'	# Must contain the directory called TeslaCamMerge (where you cloned this repository), as well as filebrowser.db
@@ -25,6 +27,36 @@ FRONT_HEIGHT = FRONT_WIDTH*3/4
 REST_WIDTH = FRONT_WIDTH/3
 REST_HEIGHT = FRONT_HEIGHT/3
 
+# Encoder settings for merged videos. FFMPEG_FULL_ENCODER is used for the
+# full videos and FFMPEG_FAST_ENCODER for the fast previews. Leave
+# FFMPEG_SCALER_FLAGS empty to use ffmpeg's default scaler (bicubic), or set
+# it to e.g. 'bilinear' or 'fast_bilinear'. FFMPEG_THREADS = 0 lets ffmpeg
+# choose. Run BenchmarkMerge.py to compare settings on your hardware.
+FFMPEG_FULL_ENCODER = '-c:v libx264'
+FFMPEG_FAST_ENCODER = '-c:v libx264 -crf 28 -profile:v main -tune fastdecode'
+FFMPEG_SCALER_FLAGS = ''
+FFMPEG_THREADS = 0
+
+# x264 preset and CRF of the full videos, picked from how far behind the
+# merges are. Each profile is (name, stamps waiting, seconds the oldest
+# stamp has waited, preset, CRF). The last profile whose number of stamps
+# or waiting time is reached is used; the preset also applies to the fast
+# previews. Once both drop below half of those of the profile in use, the
+# previous profile is used again. The first profile must have 0 and 0.
+ENCODE_PROFILES = [('quality', 0, 0, 'medium', 23),
+	('catchup', 50, 7200, 'veryfast', 25),
+	('urgent', 200, 43200, 'ultrafast', 27)]
+
+# How fast previews are made. 'retime' decodes every frame of the full
+# video and speeds it up (the behavior of older versions). 'keyframe' only
+# decodes the keyframes of the full video, which is much cheaper but looks
+# choppier the further apart the keyframes are (set with e.g. '-g 36' in
+# FFMPEG_FULL_ENCODER). 'stride' keeps every 11th frame, which saves the
+# filtering and encoding of the dropped frames. If FAST_PREVIEW_WIDTH is
+# not 0, fast previews are also scaled down to that width.
+FAST_PREVIEW_MODE = 'retime'
+FAST_PREVIEW_WIDTH = 0
+
 # TeslaCam input folders. These are the root folders in the
 # TeslaCam share (e.g. 'SavedClips', 'SentryClips') in which timestamp
 # folders are placed by TeslaCam
@@ -51,9 +83,24 @@ SHARE_PATHS = ['/samba/fjnuser/']
 
 # rclone configuration entry for Google Drive. UPLOAD_REMOTE_PATH
 # should be a properly-configured entry in your rclone.conf file.
-# Any subdirectory must already exist on Google Drive.
+# Any subdirectory must already exist on Google Drive. For testing,
+# UPLOAD_REMOTE_PATH can also be a local directory.
 UPLOAD_REMOTE_PATH = 'gdrive:/TeslaCam'
 
+# Number of files rclone uploads at the same time, and the limit passed to
+# rclone's --bwlimit. UPLOAD_BWLIMIT can be one limit such as '1M', or a
+# timetable such as '08:00,512k 23:00,off'. Leave it empty for no limit.
+UPLOAD_TRANSFERS = 4
+UPLOAD_BWLIMIT = ''
+
+# If UPLOAD_PROXY_ENCODER is not empty, videos placed in UPLOAD_LOCAL_PATH
+# are transcoded with these ffmpeg output options into UPLOAD_PROXY_PATH,
+# and the smaller proxies are uploaded instead of the originals. An
+# original is deleted once its proxy has been uploaded. For example, 720p
+# HEVC: '-vf scale=-2:720 -c:v libx265 -crf 30 -tag:v hvc1 -c:a copy'
+UPLOAD_PROXY_ENCODER = ''
+UPLOAD_PROXY_PATH = '/home/pavan/Footage/UploadProxies/'	# Must include trailing /, PROJECT_USER needs read-write permissions
+
 # Number of days to keep videos: applies to raw, full and fast videos.
 # Videos that are older than these and in the FULL_PATH, FAST_PATH and
 # RAW_PATH locations are automatically deleted by removeOld.service
@@ -61,18 +108,36 @@ UPLOAD_REMOTE_PATH = 'gdrive:/TeslaCam'
 # the UPLOAD_PATH so they are automatically backed up to cloud storage.
 DAYS_TO_KEEP = 30
 
+# When the footage disk is more than DISK_HIGH_WATERMARK percent full,
+# removeOld.service also deletes videos before they are DAYS_TO_KEEP days
+# old, until the disk is no more than DISK_LOW_WATERMARK percent full. It
+# goes through RETENTION_ORDER one (footage folder, folder) pair at a time,
+# oldest timestamps first. Raw files are only deleted for timestamps that
+# already have a full video, and full and fast videos only for timestamps
+# whose Raw files are gone, so nothing is merged again. Folders not in the
+# list are never deleted this way. Set DISK_HIGH_WATERMARK to 0 to delete only by age, e.g. 90 and 80
+# to keep a busy Sentry week from filling the disk.
+DISK_HIGH_WATERMARK = 0
+DISK_LOW_WATERMARK = 80
+RETENTION_ORDER = [('SentryClips', 'Raw'), ('SentryClips', 'Fast'), ('SentryClips', 'Full'),
+	('SavedClips', 'Raw'), ('SavedClips', 'Fast'), ('SavedClips', 'Full')]
+
 # Filename for an html file with statistics about TeslaCamMerge.
 # If STATS_FILENAME is not empty, the application will generate a
 # file in the footage directory (i.e. one level up from RAW_PATH)
 # that shows how many videos are in which folder, and the overall
 # disk usage. It then converts the HTML into an image using
 # cutycapt. If the image is successfully created, it then deletes
-# the HTML file. Stats are generated when current timestamp's minute
-# matches one of the values in STATS_FREQUENCY, so if you want
-# stats updated more frequently, add more numbers between 0 and
-# 59 to the list.
+# the HTML file. With STATS_RENDERER set to 'pillow', the image is
+# drawn directly with Pillow 5.1 or later (sudo apt install
+# python3-pil) instead, which is much lighter than starting xvfb and
+# cutycapt; set it to 'cutycapt' to use the HTML template. Stats are generated when
+# current timestamp's minute matches one of the values in
+# STATS_FREQUENCY, so if you want stats updated more frequently,
+# add more numbers between 0 and 59 to the list.
 STATS_FILENAME = 'stats.html'
 STATS_IMAGE = 'stats.png'
+STATS_RENDERER = 'pillow'
 STATS_FREQUENCY = [0, 30]
 STATS_TIMESTAMP_FORMAT = '%-I:%M %p on %a %b %-d, %Y'
 
@@ -82,6 +147,14 @@ LOG_EXTENSION = '.log'
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 LOG_LEVEL = logging.INFO
 
+# Location for state that the services keep between restarts. Must include
+# trailing /, PROJECT_USER needs read-write permissions. CATALOG_FILENAME is
+# a SQLite database in this location that records every clip, merge and
+# deletion, so that restarts do not need to rediscover all that from the
+# files. Set CATALOG_FILENAME to '' to turn the catalog off.
+STATE_PATH = '/home/pavan/state/'
+CATALOG_FILENAME = 'catalog.db'
+
 # Logging settings for TimedRotatingFileHandler, refer to:
 # https://docs.python.org/3.6/library/logging.handlers.html#timedrotatingfilehandler
 # for details about the three supported options. The default
@@ -94,11 +167,11 @@ LOG_BACKUP_COUNT = 10
 FFMPEG_PATH = '/usr/bin/ffmpeg'							# Verify with: which ffmpeg
 RCLONE_PATH = '/usr/local/bin/rclone --log-file /home/pavan/log/rclone.log'	# Verify with: which rclone
 FILEBROWSER_PATH = '/usr/local/bin/filebrowser'					# Verify with: which filebrowser
-LSOF_PATH = '/usr/bin/lsof -t'							# Verify with: which lsof
-DF_PATH = '/bin/df'								# Verify with: which df
 CUTYCAPT_PATH = '/usr/bin/cutycapt --zoom-factor=1.5'				# Verify with: which cutycapt
 SYSTEMCTL_PATH = "/bin/systemctl"						# Verify with: which systemctl
 XVFB_RUN_PATH = '/usr/bin/xvfb-run'						# Verify with: which xvfb-run
+NICE_PATH = '/usr/bin/nice'							# Verify with: which nice
+IONICE_PATH = '/usr/bin/ionice'							# Verify with: which ionice
 
 # Video watermark timestamp format (see Python strftime reference)
 WATERMARK_TIMESTAMP_FORMAT = '%b %-d\, %-I\:%M %p'		# For file timestamp, without seconds
@@ -112,6 +185,86 @@ EVENT_TIMESTAMP_FORMAT = '%b %-d\, %-I\:%M\:%S %p'		# For event timestamp with s
 BAD_VIDEOS_FILENAME = 'bad_videos.txt'
 BAD_SIZES_FILENAME = 'bad_sizes.txt'
 
+# Number of timestamps that MergeTeslaCam merges at the same time. Each one
+# runs its own ffmpeg process, so a good starting point is the number of CPU
+# cores divided by two. MERGE_QUEUE_SIZE limits how many timestamps wait for
+# a free worker; timestamps that don't fit are picked up in a later loop.
+MERGE_WORKERS = 2
+MERGE_QUEUE_SIZE = 200
+
+# When GOVERNOR_ENABLED is True, MergeTeslaCam checks every
+# GOVERNOR_INTERVAL seconds how busy and hot the computer is. Each entry in
+# GOVERNOR_LIMITS is (soft limit, hard limit) for: the one minute load
+# average divided by the number of CPUs, the percentage of time tasks waited
+# for CPU or I/O (from /proc/pressure, needs Linux 4.20 or later) and the
+# temperature in degrees Celsius. Above a soft limit, only
+# GOVERNOR_THROTTLED_WORKERS merges run at a time, with
+# GOVERNOR_THROTTLED_THREADS ffmpeg threads each. Above a hard limit, no new
+# merges start until all readings are below their soft limits again. A
+# limit of None is not checked. The merges themselves keep the CPU busy:
+# two ffmpeg commands with FFMPEG_THREADS = 0 put the load near 3 per CPU
+# and the CPU pressure near 100 on an otherwise idle computer. So the load
+# limits are set above that, and CPU pressure is not checked by default;
+# ffmpeg's nice level already lets other programs have the CPU first.
+# ffmpeg runs with nice and ionice: GOVERNOR_NICE and GOVERNOR_IONICE_CLASS
+# normally, the throttled ones otherwise (ionice class 2 is best-effort, 3
+# is idle).
+GOVERNOR_ENABLED = True
+GOVERNOR_INTERVAL = 10
+GOVERNOR_LIMITS = {'load': (4, 8), 'cpu_pressure': (None, None), 'io_pressure': (30, 60), 'temperature': (75, 82)}
+GOVERNOR_THROTTLED_WORKERS = 1
+GOVERNOR_THROTTLED_THREADS = 2
+GOVERNOR_NICE = 10
+GOVERNOR_IONICE_CLASS = 2
+GOVERNOR_THROTTLED_NICE = 19
+GOVERNOR_THROTTLED_IONICE_CLASS = 3
+
+# Order in which waiting timestamps are merged. Folders with lower numbers
+# in MERGE_FOLDER_PRIORITY go first, and within a priority the newest
+# timestamp goes first if MERGE_NEWEST_FIRST is True. A timestamp moves up
+# one priority level for every MERGE_AGING seconds it waits, so nothing
+# waits forever. With MULTI_CAR, the cars take turns.
+MERGE_FOLDER_PRIORITY = {'SavedClips': 0, 'SentryClips': 1}
+MERGE_NEWEST_FIRST = True
+MERGE_AGING = 1800
+
+# When EVENT_DRIVEN is True, LoadSSD, MergeTeslaCam and UploadDrive use
+# inotify to pick up new files shortly after they are written, instead of
+# rescanning all their folders every SLEEP_DURATION seconds. A full scan
+# still runs every RECONCILE_INTERVAL seconds to catch anything missed.
+EVENT_DRIVEN = True
+RECONCILE_INTERVAL = 900
+
+# When True, a timestamp that needs both a full and a fast video is merged
+# with a single ffmpeg command that decodes the four camera files once and
+# writes both outputs. When False, the fast video is made from the full
+# video in a second ffmpeg command (the behavior of older versions).
+SINGLE_PASS_MERGE = True
+
+# When True, once the stamps around an event are merged, their full and fast
+# videos are joined into "<event timestamp>-event-full.mp4" and
+# "<event timestamp>-event-fast.mp4" with ffmpeg's concat demuxer. The
+# videos are copied, not re-encoded, so this takes very little CPU.
+EVENT_COMPILATIONS = True
+
+# LoadSSD moves the files it finds in batches of up to TRANSFER_BATCH files,
+# copying up to TRANSFER_WORKERS files at the same time. The SSD is synced
+# once per batch. Before a file is deleted from the share, its copy is
+# compared with it: by size with 'size', by content with 'checksum' (which
+# reads the file again over the network), or not at all with ''.
+TRANSFER_WORKERS = 4
+TRANSFER_BATCH = 64
+TRANSFER_VERIFY = 'size'
+
+# Metrics in the Prometheus text format. If METRICS_PATH is not empty, each
+# service writes its metrics to a .prom file in it for node_exporter's
+# textfile collector. Must include trailing /, PROJECT_USER needs
+# read-write permissions. A service with a port other than 0 in
+# METRICS_PORTS also serves its metrics at http://METRICS_ADDRESS:port/metrics
+METRICS_PATH = ''
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORTS = {'LoadSSD': 0, 'MergeTeslaCam': 0, 'UploadDrive': 0, 'RemoveOld': 0}
+
 ### Do not modify anything below this line ###
 
 # Characteristics of filenames output by TeslaCam
@@ -121,6 +274,8 @@ RIGHT_TEXT = 'right_repeater.mp4'
 BACK_TEXT = 'back.mp4'
 FULL_TEXT = 'full.mp4'
 FAST_TEXT = 'fast.mp4'
+EVENT_FULL_TEXT = 'event-full.mp4'
+EVENT_FAST_TEXT = 'event-fast.mp4'
 FILENAME_TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
 FILENAME_REGEX  = '(\d{4}(-\d\d){2}_(\d\d-){3})(right_repeater|front|left_repeater|back).mp4'
 FILENAME_PATTERN = re.compile(FILENAME_REGEX)
@@ -152,6 +307,16 @@ SLEEP_DURATION = 60		# Seconds between looping in main tasks
 SPECIAL_EXIT_CODE = 115		# Exit code used by the app, has to be non-zero for systemctl to auto-restart crashed services
 SIZE_RANGE = 0.99		# Maximum size difference in percentage between video files, timsestamps with bigger size differences are not merged
 FFMPEG_TIMELIMIT = 9000		# CPU time limit in seconds for FFMPEG commands to run
+TRANSFER_CHUNK = 8 * 1024 * 1024	# Bytes per call when copying files from the share
+UPLOAD_RETRY_DELAY = 60		# Seconds before the first retry of a failed upload, doubled after each failure
+UPLOAD_MAX_RETRY_DELAY = 21600	# Longest wait in seconds between retries of a failed upload
+RETENTION_RESCAN = 86400		# Seconds between full rescans of the folders RemoveOld cleans up
+WRITE_QUIESCENCE = 10		# Seconds a file must go unmodified before it is considered completely written
+BAD_FILES_COMPACT_ENTRIES = 100	# Journal entries that make MergeTeslaCam rewrite a bad files list
+BAD_FILES_COMPACT_AGE = 3600		# Seconds a journal entry waits at most before the bad files list is rewritten
+
+# Snapshot of files open for writing, see refresh_open_files
+open_files = None
 
 # Common functions
 
@@ -185,21 +350,75 @@ def check_file_for_read(file):
 			"File {0} does not exist".format(file))
 		return False
 
+def refresh_open_files():
+	global open_files
+	logger = logging.getLogger(get_basename())
+	taken = time.time()
+	prefixes = tuple(os.path.realpath(path) for path in [FOOTAGE_PATH, UPLOAD_LOCAL_PATH] + SHARE_PATHS)
+	paths = set()
+	for pid in os.listdir("/proc"):
+		if not pid.isdigit():
+			continue
+		try:
+			fds = os.listdir(f"/proc/{pid}/fd")
+		except OSError:
+			continue
+		for fd in fds:
+			try:
+				target = os.readlink(f"/proc/{pid}/fd/{fd}")
+				if not target.startswith(prefixes):
+					continue
+				with open(f"/proc/{pid}/fdinfo/{fd}", "r") as info:
+					for line in info:
+						if line.startswith("flags:"):
+							if int(line.split()[1], 8) & (os.O_WRONLY | os.O_RDWR):
+								paths.add(target)
+							break
+			except (OSError, ValueError):
+				continue
+	logger.debug(f"Found {len(paths)} files open for writing in {time.time() - taken:.3f}s")
+	open_files = (taken, paths)
+
 def file_being_written(file):
 	logger = logging.getLogger(get_basename())
-	completed = subprocess.run("{0} {1}".format(LSOF_PATH, file), shell=True,
-		stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	if completed.stderr:
-		logger.error("Error running lsof on file {0}, stdout: {1}, stderr: {2}".format(
-			file, completed.stdout, completed.stderr))
-		return True # abundance of caution: if lsof won't run properly, say file is not ready for read
+	if open_files is None:
+		refresh_open_files()
+	# The open file snapshot may be a loop old, the file's age is taken now
+	paths = open_files[1]
+	try:
+		modified = os.path.getmtime(file)
+	except OSError:
+		logger.debug("File {0} disappeared".format(file))
+		return True
+	if modified > time.time() - WRITE_QUIESCENCE:
+		logger.debug("File {0} modified too recently".format(file))
+		return True
+	elif os.path.realpath(file) in paths:
+		logger.debug("File {0} open for writing".format(file))
+		return True
 	else:
-		if completed.stdout:
-			logger.debug("File {0} in use, stdout: {1}, stderr: {2}".format(
-				file, completed.stdout, completed.stderr))
-			return True
+		return False
+
+def run_timed(command):
+	# Runs a shell command like subprocess.run with captured output. The
+	# result also has the command's wall_time and cpu_time in seconds and
+	# its peak memory use in max_rss (kilobytes).
+	with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+		start = time.time()
+		process = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL,
+			stdout=stdout, stderr=stderr)
+		pid, status, usage = os.wait4(process.pid, 0)
+		if os.WIFEXITED(status):
+			process.returncode = os.WEXITSTATUS(status)
 		else:
-			return False
+			process.returncode = -os.WTERMSIG(status)
+		stdout.seek(0)
+		stderr.seek(0)
+		completed = subprocess.CompletedProcess(command, process.returncode, stdout.read(), stderr.read())
+	completed.wall_time = time.time() - start
+	completed.cpu_time = usage.ru_utime + usage.ru_stime
+	completed.max_rss = usage.ru_maxrss
+	return completed
 
 def check_file_for_write(file):
 	if os.access(file, os.F_OK):
@@ -215,6 +434,9 @@ def exit_gracefully(signum, frame):
 def get_logger():
 	basename = get_basename()
 	logger = logging.getLogger(basename)
+	if logger.handlers:
+		# Already set up by another module of the same script
+		return logger
 	logger.setLevel(LOG_LEVEL)
 	fh = logging.handlers.TimedRotatingFileHandler(
 		LOG_PATH + basename + LOG_EXTENSION,
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# This module moves batches of files for LoadSSD. A move within one file
+# system is a rename. Otherwise the kernel copies the file with
+# copy_file_range or sendfile (or a buffered copy if neither works) into a
+# hidden temporary file next to its destination, with up to
+# TRANSFER_WORKERS copies running at a time. Once the whole batch is
+# copied, the destination file system is synced once. Each copy is then
+# checked against its source as set by TRANSFER_VERIFY and renamed into
+# place, and only then is the source removed. Copies left behind by an
+# interrupted move are removed when LoadSSD starts.
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import hashlib
+import shutil
+import concurrent.futures
+import logging
+import TCMConstants
+
+libc = None
+
+def get_temporary_path(destination):
+	directory, name = os.path.split(destination)
+	return os.path.join(directory, f".{name}.part")
+
+def remove_temporary_files(directory):
+	# Removes the copies an interrupted move left behind in directory
+	logger = logging.getLogger(TCMConstants.get_basename())
+	try:
+		names = os.listdir(directory)
+	except OSError as error:
+		logger.error(f"Error listing {directory}: {error}")
+		return
+	for name in names:
+		if name.startswith(".") and name.endswith(".part"):
+			logger.info(f"Removing unfinished copy {directory}/{name}")
+			remove_quietly(os.path.join(directory, name))
+
+def copy_data(reader, writer):
+	in_fd = reader.fileno()
+	out_fd = writer.fileno()
+	if hasattr(os, "copy_file_range"):
+		try:
+			while os.copy_file_range(in_fd, out_fd, TCMConstants.TRANSFER_CHUNK) > 0:
+				pass
+			return
+		except OSError as error:
+			if os.lseek(out_fd, 0, os.SEEK_CUR) or error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+				raise
+	try:
+		while os.sendfile(out_fd, in_fd, None, TCMConstants.TRANSFER_CHUNK) > 0:
+			pass
+		return
+	except OSError as error:
+		if os.lseek(out_fd, 0, os.SEEK_CUR) or error.errno not in (errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+			raise
+	shutil.copyfileobj(reader, writer, TCMConstants.TRANSFER_CHUNK)
+
+def copy_file(source, destination):
+	temporary = get_temporary_path(destination)
+	try:
+		with open(source, "rb") as reader, open(temporary, "wb") as writer:
+			copy_data(reader, writer)
+		shutil.copystat(source, temporary)
+	except OSError:
+		remove_quietly(temporary)
+		raise
+
+def get_checksum(path):
+	digest = hashlib.md5()
+	with open(path, "rb") as file:
+		for block in iter(lambda: file.read(TCMConstants.TRANSFER_CHUNK), b""):
+			digest.update(block)
+	return digest.digest()
+
+def is_verified(source, temporary):
+	if TCMConstants.TRANSFER_VERIFY == 'checksum':
+		return get_checksum(source) == get_checksum(temporary)
+	elif TCMConstants.TRANSFER_VERIFY == 'size':
+		return os.path.getsize(source) == os.path.getsize(temporary)
+	return True
+
+def sync_directories(directories):
+	# Flushes the file systems holding the directories to disk, once each
+	global libc
+	if libc is None:
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	devices = set()
+	for directory in directories:
+		try:
+			fd = os.open(directory, os.O_RDONLY)
+		except OSError:
+			continue
+		try:
+			if os.fstat(fd).st_dev in devices:
+				continue
+			devices.add(os.fstat(fd).st_dev)
+			if not hasattr(libc, "syncfs") or libc.syncfs(fd) != 0:
+				os.sync()
+		finally:
+			os.close(fd)
+
+def remove_quietly(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+def move_files(moves):
+	# Moves a list of (source, destination) pairs, returns the set of
+	# destinations that were moved successfully
+	logger = logging.getLogger(TCMConstants.get_basename())
+	moved = set()
+	copies = []
+	for source, destination in moves:
+		try:
+			if os.stat(source).st_dev == os.stat(os.path.dirname(destination)).st_dev:
+				os.rename(source, destination)
+				moved.add(destination)
+			else:
+				copies.append((source, destination))
+		except OSError as error:
+			logger.error(f"Failed to move {source} to {destination}: {error}")
+	if not copies:
+		return moved
+
+	copied = []
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, TCMConstants.TRANSFER_WORKERS)) as executor:
+		futures = {executor.submit(copy_file, source, destination): (source, destination) for source, destination in copies}
+		for future in concurrent.futures.as_completed(futures):
+			source, destination = futures[future]
+			try:
+				future.result()
+				copied.append((source, destination))
+			except OSError as error:
+				logger.error(f"Failed to copy {source} to {destination}: {error}")
+
+	directories = {os.path.dirname(destination) for source, destination in copied}
+	sync_directories(directories)
+	renamed = []
+	for source, destination in copied:
+		temporary = get_temporary_path(destination)
+		try:
+			if not is_verified(source, temporary):
+				logger.error(f"Copy of {source} does not match the original, will try again")
+				remove_quietly(temporary)
+				continue
+			os.rename(temporary, destination)
+			renamed.append((source, destination))
+		except OSError as error:
+			logger.error(f"Failed to finish copying {source} to {destination}: {error}")
+			remove_quietly(temporary)
+	sync_directories(directories)
+	for source, destination in renamed:
+		try:
+			os.remove(source)
+		except OSError as error:
+			logger.error(f"Copied {source} but could not remove it: {error}")
+		moved.add(destination)
+	return moved
@@ -2,44 +2,225 @@
 
 # This script uploads files placed in UPLOAD_LOCAL_PATH on the
 # computer to the UPLOAD_REMOTE_PATH location using rclone.
+# Files waiting to be uploaded are kept in a queue in STATE_PATH, so
+# they survive restarts. All the files that are due are uploaded with
+# one rclone command, UPLOAD_TRANSFERS at a time. A file that fails to
+# upload is tried again later, waiting twice as long after each failure.
+# If UPLOAD_PROXY_ENCODER is set, videos are first transcoded into smaller
+# proxies in UPLOAD_PROXY_PATH, and the proxies are uploaded instead. An
+# original is only deleted once its proxy has been uploaded.
 
 import os
 import time
+import json
+import tempfile
 import subprocess
 import TCMConstants
+import Watcher
+import Metrics
+
+QUEUE_FILENAME = 'upload-queue.json'
+PROXY_EXTENSIONS = ('.mp4', '.mov', '.mkv')
+
+queue = {}	# path relative to UPLOAD_LOCAL_PATH -> {"added", "attempts", "next_try", "proxy", ...}
+upload_rate = None	# recent upload speed in bytes per second, to estimate the time proxies save
 
 logger = TCMConstants.get_logger()
 
 def main():
-	files = []
+	load_queue()
+	Metrics.start()
+	watching = TCMConstants.EVENT_DRIVEN and Watcher.start([TCMConstants.UPLOAD_LOCAL_PATH])
+	changes = None
+	last_scan = 0
 	while True:
-		try:
-			files = os.listdir(TCMConstants.UPLOAD_LOCAL_PATH)
-		except:
-			logger.error("Error listing directory {0}".format(TCMConstants.UPLOAD_LOCAL_PATH))
-			TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE)
+		TCMConstants.refresh_open_files()
+		if changes is None or time.time() - last_scan >= TCMConstants.RECONCILE_INTERVAL:
+			last_scan = time.time()
+			if not os.path.isdir(TCMConstants.UPLOAD_LOCAL_PATH):
+				logger.error("Error listing directory {0}".format(TCMConstants.UPLOAD_LOCAL_PATH))
+				TCMConstants.exit_gracefully(TCMConstants.SPECIAL_EXIT_CODE, None)
+			add_files(TCMConstants.UPLOAD_LOCAL_PATH)
+		else:
+			for path in changes:
+				add_files(path)
 
-		for file in files:
-			upload_file(file)
-		time.sleep(TCMConstants.SLEEP_DURATION)
+		upload_files()
+		Metrics.export()
+		changes = Watcher.wait(watching)
 
-def upload_file(filename):
-	logger.info("Uploading file {0}".format(filename))
+### Queue functions ###
 
-	command = "{0} move {1}{2} {3}".format(
-		TCMConstants.RCLONE_PATH, TCMConstants.UPLOAD_LOCAL_PATH,
-		filename, TCMConstants.UPLOAD_REMOTE_PATH)
-	logger.debug("Command: {0}".format(command))
+def get_queue_path():
+	return f"{TCMConstants.STATE_PATH}{QUEUE_FILENAME}"
+
+def load_queue():
 	try:
-		completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
-			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		if completed.stderr or completed.returncode != 0:
-			logger.error("Error running rclone command: {0}, returncode: {3}, stdout: {1}, stderr: {2}".format(
-				command, completed.stdout, completed.stderr, completed.returncode))
+		with open(get_queue_path(), "r") as file:
+			queue.update(json.load(file))
+		logger.info("Loaded {0} files waiting to be uploaded".format(len(queue)))
+	except FileNotFoundError:
+		pass
+	except (OSError, ValueError) as error:
+		logger.error("Error reading upload queue {0}: {1}".format(get_queue_path(), error))
+
+def save_queue():
+	try:
+		os.makedirs(TCMConstants.STATE_PATH, exist_ok=True)
+		with open(f"{get_queue_path()}.tmp", "w") as file:
+			json.dump(queue, file)
+		os.replace(f"{get_queue_path()}.tmp", get_queue_path())
+	except OSError as error:
+		logger.error("Error saving upload queue {0}: {1}".format(get_queue_path(), error))
+
+def add_files(path):
+	# Queues the file at path, or all the files under it
+	added = 0
+	if os.path.isdir(path):
+		for root, dirs, files in os.walk(path):
+			for name in files:
+				added += add_file(os.path.join(root, name))
+	elif os.path.isfile(path):
+		added += add_file(path)
+	if added:
+		save_queue()
+
+def add_file(path):
+	name = os.path.relpath(path, TCMConstants.UPLOAD_LOCAL_PATH)
+	if name in queue or os.path.basename(name).startswith("."):
+		return 0
+	logger.debug("Queueing file {0}".format(name))
+	queue[name] = {"added": time.time(), "attempts": 0, "next_try": 0, "proxy": None}
+	return 1
+
+### Proxy functions ###
+
+def get_proxy_path(name):
+	return f"{TCMConstants.UPLOAD_PROXY_PATH}{name}"
+
+def remove_proxy(name):
+	try:
+		os.remove(get_proxy_path(name))
+	except OSError:
+		pass
+
+def prepare_proxy(name):
+	# Sets the entry's "proxy" to "ready" if a proxy was made, "original"
+	# otherwise. The queue is saved with it, so an upload that is retried
+	# does not transcode the file again.
+	entry = queue[name]
+	if entry.get("proxy") == "original" or (entry.get("proxy") == "ready" and os.path.isfile(get_proxy_path(name))):
+		return
+	entry["proxy"] = "original"
+	if not TCMConstants.UPLOAD_PROXY_ENCODER or not name.lower().endswith(PROXY_EXTENSIONS):
+		return
+	original = f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}"
+	proxy = get_proxy_path(name)
+	temporary = os.path.join(os.path.dirname(proxy), f".{os.path.basename(proxy)}.part{os.path.splitext(proxy)[1]}")
+	os.makedirs(os.path.dirname(proxy), exist_ok=True)
+	command = "{0} -hide_banner -loglevel error -y -i \"{1}\" {2} -movflags +faststart \"{3}\"".format(
+		TCMConstants.FFMPEG_PATH, original, TCMConstants.UPLOAD_PROXY_ENCODER, temporary)
+	logger.info("Making upload proxy for {0}".format(name))
+	logger.debug("Command: {0}".format(command))
+	completed = TCMConstants.run_timed(command)
+	if completed.returncode != 0 or not os.path.isfile(temporary):
+		logger.error("Error making proxy with: {0}, returncode: {1}, stderr: {2}".format(command, completed.returncode, completed.stderr))
+		if os.path.isfile(temporary):
+			os.remove(temporary)
+		return
+	original_size = os.path.getsize(original)
+	proxy_size = os.path.getsize(temporary)
+	Metrics.observe('tcm_proxy_transcode_seconds', completed.wall_time)
+	if proxy_size >= original_size:
+		logger.info("Proxy for {0} is not smaller than the original, uploading the original".format(name))
+		os.remove(temporary)
+		return
+	os.replace(temporary, proxy)
+	entry.update({"proxy": "ready", "original_size": original_size, "proxy_size": proxy_size, "transcode_time": completed.wall_time})
+
+def record_proxy_upload(name, entry):
+	saved = entry["original_size"] - entry["proxy_size"]
+	seconds = saved / upload_rate if upload_rate else 0
+	logger.info("Uploaded proxy of {0}: {1} to {2} ({3:.0%}), transcoded in {4:.0f}s, saved about {5:.0f}s of upload".format(
+		name, TCMConstants.convert_file_size(entry["original_size"]).strip(),
+		TCMConstants.convert_file_size(entry["proxy_size"]).strip(), entry["proxy_size"] / entry["original_size"],
+		entry["transcode_time"], seconds))
+	Metrics.increment('tcm_proxy_saved_bytes_total', saved)
+	Metrics.increment('tcm_proxy_saved_seconds_total', seconds)
+
+### Upload functions ###
+
+def upload_files():
+	global upload_rate
+	now = time.time()
+	for name in [name for name in queue if not os.path.isfile(f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}")]:
+		logger.info("File {0} is no longer in the upload folder, dropping it".format(name))
+		remove_proxy(name)
+		del queue[name]
+	due = sorted(name for name, entry in queue.items() if entry["next_try"] <= now
+		and TCMConstants.check_file_for_read(f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}"))
+	if not due:
+		return
+	for name in due:
+		prepare_proxy(name)
+	save_queue()
+	sources = {name: get_proxy_path(name) if queue[name]["proxy"] == "ready" else f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}" for name in due}
+	sizes = {name: os.path.getsize(source) for name, source in sources.items()}
+	logger.info("Uploading {0} files".format(len(due)))
+	start = time.time()
+	failed = False
+	for source_path, names in [(TCMConstants.UPLOAD_LOCAL_PATH, [name for name in due if queue[name]["proxy"] != "ready"]),
+			(TCMConstants.UPLOAD_PROXY_PATH, [name for name in due if queue[name]["proxy"] == "ready"])]:
+		if names:
+			completed = run_rclone(names, source_path)
+			failed = failed or completed is None or completed.returncode != 0
+	uploaded = [name for name in due if not os.path.isfile(sources[name])]
+	if uploaded:
+		rate = sum(sizes[name] for name in uploaded) / max(time.time() - start, 0.001)
+		upload_rate = rate if upload_rate is None else (upload_rate + rate) / 2
+	for name in due:
+		entry = queue[name]
+		if name not in uploaded:
+			entry["attempts"] += 1
+			delay = min(TCMConstants.UPLOAD_RETRY_DELAY * 2 ** (entry["attempts"] - 1), TCMConstants.UPLOAD_MAX_RETRY_DELAY)
+			entry["next_try"] = time.time() + delay
+			logger.warning("Failed to upload {0} (attempt {1}), trying again in {2:.0f}s".format(name, entry["attempts"], delay))
+			continue
+		if entry["proxy"] == "ready":
+			try:
+				os.remove(f"{TCMConstants.UPLOAD_LOCAL_PATH}{name}")
+			except OSError as error:
+				logger.error("Uploaded proxy of {0} but could not remove the original: {1}".format(name, error))
+			record_proxy_upload(name, entry)
 		else:
-			logger.info("Uploaded file {0}".format(filename))
-	except shutil.Error:
-		logger.error("Failed to upload {0}".format(filename))
+			logger.info("Uploaded file {0}".format(name))
+		Metrics.increment('tcm_uploaded_files_total')
+		Metrics.increment('tcm_uploaded_bytes_total', sizes[name])
+		del queue[name]
+	if failed:
+		Metrics.increment('tcm_rclone_failures_total')
+	save_queue()
+
+def run_rclone(names, source_path):
+	with tempfile.NamedTemporaryFile("w", prefix="tcm-upload-", suffix=".txt") as files_from:
+		files_from.write("".join(f"{name}\n" for name in names))
+		files_from.flush()
+		command = "{0} move {1} {2} --files-from {3} --transfers {4} --delete-empty-src-dirs".format(
+			TCMConstants.RCLONE_PATH, source_path,
+			TCMConstants.UPLOAD_REMOTE_PATH, files_from.name, TCMConstants.UPLOAD_TRANSFERS)
+		if TCMConstants.UPLOAD_BWLIMIT:
+			command += " --bwlimit \"{0}\"".format(TCMConstants.UPLOAD_BWLIMIT)
+		logger.debug("Command: {0}".format(command))
+		try:
+			completed = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError as error:
+			logger.error("Failed to run rclone command: {0}, error: {1}".format(command, error))
+			return None
+	if completed.stderr or completed.returncode != 0:
+		logger.error("Error running rclone command: {0}, returncode: {3}, stdout: {1}, stderr: {2}".format(
+			command, completed.stdout, completed.stderr, completed.returncode))
+	return completed
 
 if __name__ == '__main__':
 	main()
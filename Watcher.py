@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# This module lets the services wait for files with inotify instead of
+# sleeping for SLEEP_DURATION and rescanning. Only one set of watches is
+# kept per process. wait_for_changes returns paths that were closed after
+# writing or moved into a watched directory, but holds each path back until
+# WRITE_QUIESCENCE seconds after its last event so that check_file_for_read
+# considers it complete by the time the service handles it.
+
+import os
+import ctypes
+import ctypes.util
+import struct
+import select
+import time
+import logging
+import TCMConstants
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+libc = None
+inotify_fd = None
+recursive_watch = False
+watches = {}	# watch descriptor -> directory
+buffered = {}	# path -> time of the last event for it
+overflowed = False
+
+def start(paths, recursive=False):
+	global libc, inotify_fd, recursive_watch
+	logger = logging.getLogger(TCMConstants.get_basename())
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+	except (OSError, AttributeError):
+		logger.warning("inotify is not available, falling back to polling")
+		return False
+	if inotify_fd < 0:
+		logger.warning(f"inotify_init1 failed with errno {ctypes.get_errno()}, falling back to polling")
+		inotify_fd = None
+		return False
+	recursive_watch = recursive
+	for path in paths:
+		add_watch(path.rstrip("/"))
+	logger.info(f"Watching {len(watches)} directories for new files")
+	return True
+
+def add_watch(path):
+	mask = IN_CLOSE_WRITE | IN_MOVED_TO
+	if recursive_watch:
+		mask |= IN_CREATE
+	wd = libc.inotify_add_watch(inotify_fd, os.fsencode(path), mask)
+	if wd < 0:
+		logging.getLogger(TCMConstants.get_basename()).error(
+			f"Could not watch {path}, errno {ctypes.get_errno()}")
+		return
+	watches[wd] = path
+	if recursive_watch:
+		try:
+			entries = list(os.scandir(path))
+		except OSError:
+			return
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				add_watch(entry.path)
+
+def add_directory(path):
+	# Files can land in a new directory before the watch on it is added,
+	# so report everything already inside it as well
+	add_watch(path)
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			buffered[os.path.join(root, name)] = time.time()
+
+def read_events():
+	global overflowed
+	try:
+		data = os.read(inotify_fd, 65536)
+	except BlockingIOError:
+		return
+	offset = 0
+	while offset < len(data):
+		wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+		offset += EVENT_HEADER.size
+		name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+		offset += length
+		if mask & IN_Q_OVERFLOW:
+			overflowed = True
+		elif mask & IN_IGNORED:
+			watches.pop(wd, None)
+		elif wd in watches:
+			path = os.path.join(watches[wd], name)
+			if mask & IN_ISDIR:
+				if recursive_watch:
+					add_directory(path)
+				elif mask & IN_MOVED_TO:
+					buffered[path] = time.time()
+			elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+				buffered[path] = time.time()
+
+def wait_for_changes(timeout):
+	# Returns the set of changed paths, or None if events were lost and the
+	# caller should do a full scan
+	global overflowed
+	deadline = time.time() + timeout
+	while True:
+		now = time.time()
+		if overflowed:
+			logging.getLogger(TCMConstants.get_basename()).warning("inotify queue overflowed, rescanning")
+			overflowed = False
+			buffered.clear()
+			return None
+		ready = {path for path, stamp in buffered.items() if now - stamp > TCMConstants.WRITE_QUIESCENCE}
+		if ready:
+			for path in ready:
+				del buffered[path]
+			return ready
+		if now >= deadline:
+			return set()
+		wait = deadline - now
+		if buffered:
+			wait = min(wait, min(buffered.values()) + TCMConstants.WRITE_QUIESCENCE + 1 - now)
+		readable, _, _ = select.select([inotify_fd], [], [], max(wait, 0))
+		if readable:
+			read_events()
+
+def wait(watching):
+	# Waits for the next iteration of a service loop. Returns the changed
+	# paths when watching, or None to ask for a full scan
+	if watching:
+		return wait_for_changes(TCMConstants.SLEEP_DURATION)
+	else:
+		time.sleep(TCMConstants.SLEEP_DURATION)
+		return None